@@ -0,0 +1,107 @@
+'''Compares the columnar create_covid_cases_columns transform with the
+original row-by-row create_covid_cases_dict (kept here as
+legacy_create_covid_cases_dict), on synthetic API responses.
+
+usage: python benchmarks/bench_cases_transform.py [--regions N ...] [--repeat N]
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import finalproject
+
+
+def legacy_create_covid_cases_dict(covid_json):
+    '''The original transform: five parallel lists of strings and zero-filled
+    nulls, then a second loop to assemble the dict.'''
+    all_countries = covid_json['response']
+
+    countries_list = []
+    new_cases_list = []
+    active_cases_list = []
+    total_cases_list = []
+    new_deaths_list = []
+
+    for country in all_countries:
+        c = country['country']
+        if c == "USA":
+            c = "United States"
+        if c == "S-Korea":
+            c = "South Korea"
+        if "-" in c:
+            c = c.replace("-", " ")
+        countries_list.append(c)
+
+        active_cases = country['cases']['active']
+        if active_cases == None:
+            active_cases = 0
+        active_cases_list.append(active_cases)
+
+        total_cases = country['cases']['total']
+        if total_cases == None:
+            total_cases = 0
+        total_cases_list.append(total_cases)
+
+        new_cases = country['cases']['new']
+        if new_cases != None:
+            new_cases = new_cases[1:]
+        if new_cases == None:
+            new_cases = 0
+        new_cases_list.append(new_cases)
+
+        new_deaths = country['deaths']['new']
+        if new_deaths != None:
+            new_deaths = new_deaths[1:]
+        if new_deaths == None:
+            new_deaths = 0
+        new_deaths_list.append(new_deaths)
+
+    covid_dict = {}
+    for i in range(len(countries_list)):
+        covid_dict[countries_list[i]] = {
+            'new cases': new_cases_list[i],
+            'active cases': active_cases_list[i],
+            'new deaths': new_deaths_list[i],
+            'total cases': total_cases_list[i]
+        }
+    return covid_dict
+
+
+def best_of(function, argument, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--regions', type=int, nargs='+', default=[10_000, 50_000, 200_000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for n in args.regions:
+        covid_json = fixtures.covid_response(n)
+        legacy = best_of(legacy_create_covid_cases_dict, covid_json, args.repeat)
+        columnar = best_of(finalproject.create_covid_cases_columns, covid_json, args.repeat)
+
+        # the legacy totals should match wherever the new path has a value
+        columns = finalproject.create_covid_cases_columns(covid_json)
+        expected = [v['total cases'] for v in legacy_create_covid_cases_dict(covid_json).values()]
+        if columns['total cases'].filled(0).tolist() != expected:
+            print("[Error] The transforms disagree on total cases.")
+            sys.exit(1)
+
+        print(f"{n:>8} regions: legacy {legacy * 1000:8.1f} ms  columnar {columnar * 1000:8.1f} ms  "
+              f"({legacy / columnar:.2f}x, {n / columnar:,.0f} regions/sec)")
+
+
+if __name__ == '__main__':
+    main()
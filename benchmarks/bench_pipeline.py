@@ -0,0 +1,296 @@
+'''Times every stage of the ingest -> query -> render path offline, against
+the recorded fixtures (1x) and synthetic payloads scaled up from them.
+
+usage: python benchmarks/bench_pipeline.py [--scales N ...] [--repeat N] [--save NAME]
+                                           [--compare NAME] [--threshold PCT] [--min-ms MS]
+
+For each stage and scale it reports the best wall time over --repeat runs,
+then runs the stage once more under tracemalloc for the peak memory it
+allocated and the number of memory blocks it retained (still allocated
+afterwards, net of what it freed). It also times
+fresh processes: a bare interpreter, importing finalproject, and a
+percentage query from the command line.
+
+--save writes the results to benchmarks/baselines/NAME.json. --compare
+diffs a run against a saved baseline and exits with status 1 if any stage
+got slower (or used more memory) by more than --threshold percent. Time
+changes smaller than --min-ms are treated as noise. Baselines only mean
+something on the machine and Python that recorded them, so they are not
+kept in the repo: save one before changing anything, then compare to it.
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fixtures
+import finalproject
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+# (base population rows, base covid regions) scaled by --scales
+BASE_ROWS = (235, 230)
+
+# the database file the script opens from its working directory
+DB_FILENAME = finalproject.DB_NAME
+
+# countries drawn one by one in the render stages
+RENDERED_COUNTRIES = 50
+
+
+def stage_parse_population(ctx):
+    ctx['population'] = finalproject.parse_population_table(ctx['html'])
+
+
+def stage_cases_transform(ctx):
+    ctx['cases'] = finalproject.create_covid_cases_columns(ctx['covid_json'])
+
+
+def stage_load_population(ctx):
+    finalproject.load_population(ctx['population'])
+
+
+def stage_load_cases(ctx):
+    finalproject.load_cases(ctx['cases'])
+
+
+def stage_refresh_unchanged(ctx):
+    finalproject.refresh_cases(ctx['cases'])
+
+
+def stage_query_all(ctx):
+    finalproject.access_cases_table("all")
+
+
+def stage_query_batch(ctx):
+    finalproject.access_countries_batch(ctx['names'])
+
+
+def stage_query_top(ctx):
+    finalproject.access_top_countries('cases_per_capita', 20)
+
+
+def stage_search(ctx):
+    index = finalproject.CountrySearchIndex(finalproject.get_connection().execute(finalproject.ALL_ALIASES_SQL))
+    for name in ctx['misspelled']:
+        index.search(name)
+
+
+def stage_render_figures(ctx):
+    for view in ('all', 'top', 'regions'):
+        json.dumps(finalproject.render_figure(view))
+    for name in ctx['names'][:RENDERED_COUNTRIES]:
+        json.dumps(finalproject.render_figure('cases', name))
+        json.dumps(finalproject.render_figure('population', name))
+
+
+def stage_cached_figures(ctx):
+    for view in ('all', 'top', 'regions'):
+        finalproject.FIGURE_CACHE.get(view)
+    for name in ctx['names'][:RENDERED_COUNTRIES]:
+        finalproject.FIGURE_CACHE.get('cases', name)
+        finalproject.FIGURE_CACHE.get('population', name)
+
+
+# in pipeline order: later stages read what earlier ones produced or loaded
+STAGES = [
+    ('parse_population', stage_parse_population),
+    ('cases_transform', stage_cases_transform),
+    ('load_population', stage_load_population),
+    ('load_cases', stage_load_cases),
+    ('refresh_unchanged', stage_refresh_unchanged),
+    ('query_all', stage_query_all),
+    ('query_batch', stage_query_batch),
+    ('query_top', stage_query_top),
+    ('search', stage_search),
+    ('render_figures', stage_render_figures),
+    ('cached_figures', stage_cached_figures),
+]
+
+
+def inputs(scale):
+    '''Returns the raw payloads for a scale: the recorded fixtures at 1x,
+    generated ones above that.'''
+    if scale == 1:
+        with open(fixtures.POPULATION_PAGE, encoding='utf-8') as f:
+            html = f.read()
+        with open(fixtures.COVID_RESPONSE, encoding='utf-8') as f:
+            covid_json = json.load(f)
+    else:
+        html = fixtures.population_page(BASE_ROWS[0] * scale)
+        covid_json = fixtures.covid_response(BASE_ROWS[1] * scale)
+    names = [entry['country'] for entry in covid_json['response']]
+    return {
+        'html': html,
+        'covid_json': covid_json,
+        'names': names,
+        'misspelled': [name[::-1] for name in names[:100]],
+    }
+
+
+def measure(function, ctx, repeat):
+    '''Returns (best seconds, peak bytes, blocks retained) for a stage.'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(ctx)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    function(ctx)
+    peak = tracemalloc.get_traced_memory()[1]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks_retained = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return best, peak, blocks_retained
+
+
+def measure_startup(database, country, repeat):
+    '''Times fresh python processes against a copy of a loaded database.
+
+    returns
+    -------
+    dict
+        {"name@startup": {"time_ms", "peak_kib", "blocks_retained"}}, with no memory
+        figures since the work happens in another process
+    '''
+    commands = {
+        'interpreter': [sys.executable, '-c', 'pass'],
+        'import': [sys.executable, '-c', 'import finalproject'],
+        'percentage_cli': [sys.executable, '-m', 'finalproject', 'percentage', country],
+    }
+    workdir = os.path.dirname(database)
+    with sqlite3.connect(database) as source, sqlite3.connect(os.path.join(workdir, DB_FILENAME)) as copy:
+        source.backup(copy)
+    env = dict(os.environ, PYTHONPATH=PACKAGE_DIR)
+
+    results = {}
+    for name, command in commands.items():
+        # the first run also writes the bytecode cache
+        subprocess.run(command, cwd=workdir, env=env, capture_output=True, check=True)
+        best = float('inf')
+        for _ in range(max(repeat, 5)):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=workdir, env=env, capture_output=True, check=True)
+            best = min(best, time.perf_counter() - start)
+        results[f"{name}@startup"] = {'time_ms': round(best * 1000, 3), 'peak_kib': None, 'blocks_retained': None}
+        print(f"{name + '@startup':>24}: {best * 1000:10.2f} ms")
+    return results
+
+
+def run(scales, repeat):
+    '''Runs every stage at every scale against a scratch database.
+
+    returns
+    -------
+    dict
+        {"stage@Nx": {"time_ms", "peak_kib", "blocks_retained"}}
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        for scale in scales:
+            finalproject.DB_NAME = os.path.join(scratch, f"bench_{scale}x.sqlite")
+            finalproject.close_connection()
+            finalproject.FIGURE_CACHE.clear()
+            with contextlib.redirect_stdout(io.StringIO()):
+                finalproject.create_db()
+            ctx = inputs(scale)
+
+            if scale == scales[0]:
+                first_database, first_country = finalproject.DB_NAME, ctx['names'][0]
+
+            for name, function in STAGES:
+                # the loaders report their progress; keep it out of the table
+                with contextlib.redirect_stdout(io.StringIO()):
+                    seconds, peak, blocks_retained = measure(function, ctx, repeat)
+                results[f"{name}@{scale}x"] = {
+                    'time_ms': round(seconds * 1000, 3),
+                    'peak_kib': round(peak / 1024, 1),
+                    'blocks_retained': blocks_retained,
+                }
+                print(f"{name + '@' + str(scale) + 'x':>24}: {seconds * 1000:10.2f} ms  "
+                      f"peak {peak / 1024:10.1f} KiB  {blocks_retained:>8} blocks retained")
+            finalproject.close_connection()
+        results.update(measure_startup(first_database, first_country, repeat))
+    return results
+
+
+def compare(results, baseline, threshold, min_ms=0.0):
+    '''Prints each stage's change against a baseline.
+
+    returns
+    -------
+    list
+        the stages that regressed by more than threshold percent
+    '''
+    regressions = []
+    print(f"\n{'stage':>24}  {'time':>22}  {'peak memory':>26}")
+    for stage, now in results.items():
+        then = baseline.get(stage)
+        if then is None:
+            print(f"{stage:>24}  (not in baseline)")
+            continue
+        changes = []
+        for field in ('time_ms', 'peak_kib'):
+            if now[field] is None or then[field] is None:
+                changes.append(0.0)
+                continue
+            change = (now[field] - then[field]) / then[field] * 100 if then[field] else 0.0
+            changes.append(change)
+            if change > threshold and not (field == 'time_ms' and now[field] - then[field] < min_ms):
+                regressions.append(f"{stage} {field}")
+        memory = ""
+        if now['peak_kib'] is not None and then['peak_kib'] is not None:
+            memory = f"  {then['peak_kib']:9.1f} -> {now['peak_kib']:9.1f} KiB {changes[1]:+6.1f}%"
+        print(f"{stage:>24}  {then['time_ms']:9.2f} -> {now['time_ms']:9.2f} ms {changes[0]:+6.1f}%" + memory)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', metavar='NAME', help="save the results as a baseline")
+    parser.add_argument('--compare', metavar='NAME', help="diff the results against a saved baseline")
+    parser.add_argument('--threshold', type=float, default=20.0, help="percent change counted as a regression")
+    parser.add_argument('--min-ms', type=float, default=1.0, help="smallest time change counted as a regression")
+    args = parser.parse_args()
+
+    results = run(args.scales, args.repeat)
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, args.save + '.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'recorded': time.strftime('%Y-%m-%d'),
+                'results': results,
+            }, f, indent=2)
+            f.write('\n')
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, args.compare + '.json'), encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold, args.min_ms)
+        if regressions:
+            print(f"[Error] Regressed by more than {args.threshold:g}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+'''Compares the streaming population parser with the BeautifulSoup
+implementation it replaced, on a saved copy of the UN population article.
+
+usage: python benchmarks/bench_population_parser.py [--page PATH] [--repeat N]
+
+Reports the best parse time and the peak traced memory of each parser, and
+checks that both produce the same records.
+'''
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+
+import fixtures
+import finalproject
+
+
+def legacy_parse_population_table(html):
+    '''The original scrape_wiki_data parsing: a full html.parser soup, the
+    prettified copy that used to be cached, and six parallel lists.'''
+    soup = BeautifulSoup(html, "html.parser")
+    soup.prettify()
+
+    countries_table = soup.find_all('table', class_='sortable')
+    table = countries_table[0].find_all('th')
+    all_headings = [th.text.strip() for th in table]
+
+    countries_list = []
+    UN_CR_list = []
+    UN_SR_list = []
+    pop_2018_list = []
+    pop_2019_list = []
+    change_list = []
+    countries_pop_dict = {}
+
+    countries_table = soup.find_all('table', class_='sortable')
+    tbody = countries_table[0].find('tbody')
+    trs = tbody.find_all('tr', recursive=False)
+
+    for tr in trs:
+        tds = tr.find_all('td')
+        if not tds:
+            continue
+        country_name = tds[0].text.strip()
+        if "[" in country_name:
+            country_name = country_name[:-3]
+        countries_list.append(country_name)
+        UN_CR_list.append(tds[1].text.strip())
+        UN_SR_list.append(tds[2].text.strip())
+        pop_2018_list.append(int(tds[3].text.strip().replace(',', '')))
+        pop_2019_list.append(int(tds[4].text.strip().replace(',', '')))
+        change_list.append(tds[5].text.strip())
+
+    for i in range(len(countries_list)):
+        countries_pop_dict[countries_list[i]] = {
+            'UN continental region': UN_CR_list[i],
+            'UN statistical region': UN_SR_list[i],
+            '2018 population': pop_2018_list[i],
+            '2019 population': pop_2019_list[i],
+            'percentage population change': change_list[i]
+        }
+    return countries_pop_dict
+
+
+def measure(parse, html, repeat):
+    '''Returns (best seconds, peak traced bytes, result) for one parser.'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = parse(html)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    parse(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--page', default=fixtures.POPULATION_PAGE, help="saved copy of the article")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.page):
+        fixtures.write_fixtures()
+    with open(args.page, encoding='utf-8') as f:
+        html = f.read()
+
+    print(f"page: {args.page} ({len(html) / 1024:.0f} KiB)")
+    legacy = measure(legacy_parse_population_table, html, args.repeat)
+    streaming = measure(finalproject.parse_population_table, html, args.repeat)
+
+    for name, (seconds, peak, records) in (("beautifulsoup", legacy), ("streaming", streaming)):
+        print(f"{name:>14}: {seconds * 1000:8.1f} ms  peak {peak / 1024 / 1024:6.1f} MiB  {len(records)} rows")
+    print(f"{'speedup':>14}: {legacy[0] / streaming[0]:8.1f}x  memory {legacy[1] / streaming[1]:.0f}x less")
+
+    if legacy[2] != streaming[2]:
+        print("[Error] The parsers disagree on the table contents.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+'''Builds the offline fixtures the benchmarks run against.
+
+The pages mimic the layout of the UN population article (flag icons,
+footnote markers, a second sortable table and a long tail of references)
+so parsers do the same work they would on the live page.
+
+Run this file directly to (re)write the saved fixtures in benchmarks/fixtures.
+'''
+
+import json
+import os
+import random
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+POPULATION_PAGE = os.path.join(FIXTURE_DIR, "un_population.html")
+COVID_RESPONSE = os.path.join(FIXTURE_DIR, "covid_statistics.json")
+
+REGIONS = [
+    ("Asia", "Eastern Asia"),
+    ("Asia", "Southern Asia"),
+    ("Africa", "Western Africa"),
+    ("Americas", "South America"),
+    ("Europe", "Western Europe"),
+    ("Oceania", "Polynesia"),
+]
+
+
+def population_page(n_rows=235, seed=507):
+    '''Returns the html of a synthetic UN population article.
+
+    params
+    ------
+    n_rows : int
+        number of country rows in the population table
+    seed : int
+        seed for the generated figures
+
+    returns
+    -------
+    str
+        the page's html
+    '''
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n_rows):
+        name = f"Country {i:04d}"
+        note = f'<sup id="cite_ref-{i}" class="reference"><a href="#cite_note-{i}">[{chr(97 + i % 26)}]</a></sup>' if i % 7 == 0 else ""
+        continental, statistical = REGIONS[i % len(REGIONS)]
+        pop_2018 = rng.randint(800, 1_400_000_000)
+        pop_2019 = int(pop_2018 * rng.uniform(0.97, 1.04))
+        change = (pop_2019 - pop_2018) / pop_2018 * 100
+        rows.append(
+            f'<tr>\n<td style="text-align:left"><span class="flagicon"><img alt="" src="//upload.wikimedia.org/flag_{i}.svg" '
+            f'decoding="async" width="23" height="15" class="thumbborder" /></span>&#160;<a href="/wiki/{name.replace(" ", "_")}" '
+            f'title="{name}">{name}</a>{note}</td>\n<td><a href="/wiki/{continental}" title="{continental}">{continental}</a></td>\n'
+            f'<td>{statistical}</td>\n<td>{pop_2018:,}</td>\n<td>{pop_2019:,}</td>\n'
+            f'<td><span data-sort-value="{change:.3f}">{change:+.2f}%</span></td>\n</tr>\n'
+        )
+
+    head = (
+        '<!DOCTYPE html>\n<html class="client-nojs" lang="en" dir="ltr">\n<head>\n<meta charset="UTF-8"/>\n'
+        '<title>List of countries by population (United Nations) - Wikipedia</title>\n'
+        + '<link rel="stylesheet" href="/w/load.php?modules=site.styles" />\n' * 40
+        + '</head>\n<body>\n<div id="content"><p>This is a list of countries and other inhabited territories of the world by total population.</p>\n'
+    )
+    table = (
+        '<table class="wikitable sortable" style="text-align:right">\n<tbody><tr>\n'
+        '<th>Country or area</th>\n<th>UN continental<br />region<sup>[4]</sup></th>\n'
+        '<th>UN statistical<br />region<sup>[4]</sup></th>\n<th>Population<br />(1 July 2018)</th>\n'
+        '<th>Population<br />(1 July 2019)</th>\n<th>Change</th>\n</tr>\n'
+        + "".join(rows)
+        + '</tbody></table>\n'
+    )
+    tail = (
+        '<h2>Notes</h2>\n<table class="wikitable sortable"><tbody>'
+        + "".join(f'<tr><td>Note {i}</td><td>{"lorem ipsum " * 8}</td></tr>\n' for i in range(60))
+        + '</tbody></table>\n<h2>References</h2>\n<ol class="references">\n'
+        + "".join(
+            f'<li id="cite_note-{i}"><span class="reference-text"><a rel="nofollow" class="external text" '
+            f'href="https://population.un.org/wpp/{i}">World Population Prospects {i}</a>. United Nations. '
+            f'Retrieved {1 + i % 28} July 2019.</span></li>\n'
+            for i in range(1500)
+        )
+        + '</ol>\n</div>\n</body>\n</html>\n'
+    )
+    return head + table + tail
+
+
+def covid_response(n_regions=230, seed=507):
+    '''Returns a synthetic covid-193 /statistics response.
+
+    Roughly a fifth of the "new" figures and a tenth of the active counts are
+    missing, as they are in the live API. Countries are named like the ones
+    in population_page, with the API's dashes, so the two sources join.
+
+    params
+    ------
+    n_regions : int
+        number of entries in the response
+    seed : int
+        seed for the generated figures
+
+    returns
+    -------
+    dict
+        the decoded json response
+    '''
+    rng = random.Random(seed)
+    response = []
+    for i in range(n_regions):
+        total = rng.randint(0, 30_000_000)
+        deaths = total // rng.randint(20, 80)
+        recovered = total // 2
+        active = total - deaths - recovered
+        response.append({
+            "continent": REGIONS[i % len(REGIONS)][0],
+            "country": f"Country-{i:04d}",
+            "population": rng.randint(800, 1_400_000_000),
+            "cases": {
+                "new": f"+{rng.randint(0, 90000)}" if rng.random() > 0.2 else None,
+                "active": active if rng.random() > 0.1 else None,
+                "critical": rng.randint(0, 9000),
+                "recovered": recovered,
+                "1M_pop": str(rng.randint(0, 300000)),
+                "total": total,
+            },
+            "deaths": {
+                "new": f"+{rng.randint(0, 2000)}" if rng.random() > 0.3 else None,
+                "1M_pop": str(rng.randint(0, 5000)),
+                "total": deaths,
+            },
+            "tests": {"1M_pop": None, "total": None},
+            "day": "2020-04-20",
+            "time": "2020-04-20T12:15:06+00:00",
+        })
+    return {"get": "statistics", "parameters": [], "errors": [], "results": n_regions, "response": response}
+
+
+def write_fixtures():
+    '''Writes the saved fixture files.'''
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    with open(POPULATION_PAGE, 'w', encoding='utf-8') as f:
+        f.write(population_page())
+    with open(COVID_RESPONSE, 'w', encoding='utf-8') as f:
+        json.dump(covid_response(), f, indent=1)
+        f.write('\n')
+
+
+if __name__ == '__main__':
+    write_fixtures()
@@ -3,610 +3,4190 @@
 ################    Uniqname: cginiel          ##############
 #############################################################
 
-from bs4 import BeautifulSoup
-import requests
+from collections import OrderedDict, defaultdict
+from html.parser import HTMLParser
+import argparse
+import atexit
+import bisect
+import contextlib
+import contextvars
 import sys
-import secrets
+import csv
+import functools
+import datetime
+import gzip
+import hashlib
+import http
+import itertools
 import json
+import mmap
+import os
+import pkgutil
+import random
+import re
 import sqlite3
+import zlib
+import threading
 import time
-import plotly.graph_objects as go
+import unicodedata
+import urllib.parse
+
+try:
+    import fcntl
+except ImportError: # windows: the cache log isn't shared between processes
+    fcntl = None
+
+# requests, numpy and plotly are imported by the functions that use them, so
+# read-only queries start without paying for them
 
 
 ################## global vars ##############################
-CACHE_FILENAME = "covid_cache.json"
+CACHE_FILENAME = "covid_cache.log"
 CACHE_DICT = {}
 
-API_KEY = secrets.rapid_api_key
+# the log is compacted once dead records outweigh live ones, and the least
+# recently used entries are evicted once live entries exceed CACHE_MAX_BYTES
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_COMPACT_MIN_BYTES = 1024 * 1024
+
+# the RapidAPI key, from RAPIDAPI_KEY or else from rapidapi_key.txt (see get_api_key)
+API_KEY = os.environ.get('RAPIDAPI_KEY')
 covid_url = "https://covid-193.p.rapidapi.com/statistics"
+history_url = "https://covid-193.p.rapidapi.com/history"
+countries_url = "https://covid-193.p.rapidapi.com/countries"
+wikipedia_url = "https://en.wikipedia.org/wiki/List_of_countries_by_population_(United_Nations)"
+
+# seconds a cached response is served without contacting the source
+CACHE_TTL = {
+    covid_url: 15 * 60,
+    wikipedia_url: 7 * 24 * 60 * 60,
+}
+DEFAULT_CACHE_TTL = 60 * 60
+
+# extra seconds past the TTL during which the stale copy is still served
+# while a background request revalidates it
+CACHE_STALE_TTL = {
+    covid_url: 60 * 60,
+    wikipedia_url: 30 * 24 * 60 * 60,
+}
+DEFAULT_CACHE_STALE_TTL = 0
+
+REQUEST_TIMEOUT = 30
+
+# startup ingestion: fetches in flight at once, the request timeout for each
+# attempt, retries after the first attempt and the delay before the first retry
+INGEST_CONCURRENCY = 4
+INGEST_TIMEOUT = REQUEST_TIMEOUT
+INGEST_RETRIES = 3
+INGEST_BACKOFF = 1.0
+
+# history backfill: worker threads, and requests per second to the API host
+# shared by all of them
+BACKFILL_WORKERS = 4
+BACKFILL_REQUESTS_PER_SECOND = 2.0
+RATE_LIMITERS = {}
+
+# background refresher: seconds between refreshes of each kind of record, and the
+# fraction by which each wait is randomly stretched or shrunk
+REFRESH_INTERVALS = {
+    'cases': 15 * 60,
+    'population': 24 * 60 * 60,
+}
+REFRESH_JITTER = 0.1
+PARSE_CHUNK_SIZE = 64 * 1024
+SESSION = None
+CACHE_LOCK = threading.RLock()
+REVALIDATING = set()
+
+# marks a figure the API did not report, before it is masked out (the
+# smallest int64)
+NULL_COUNT = -2 ** 63
+
+DB_NAME = 'covid_stats.sqlite'
+
+# days of history kept at daily resolution before being rolled up into weeks
+HISTORY_DAILY_RETENTION_DAYS = 90
+# smallest trigram similarity (0 to 1) for a fuzzy country match
+SEARCH_MIN_SCORE = 0.3
+
+# memory allowed for rendered figures kept by FIGURE_CACHE
+FIGURE_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# all-countries chart: countries drawn before the rest are summed into
+# "Others", and points per page when it is paged
+ALL_CHART_TOP_N = 20
+ALL_CHART_PAGE_SIZE = 100
+
+# read-only HTTP API: address, query threads, and the smallest response
+# worth compressing
+API_HOST = "127.0.0.1"
+API_PORT = 8050
+API_WORKERS = 4
+API_GZIP_MIN_BYTES = 1024
+
+# instrumentation: collect stage timings and counters (also turned on by
+# --metrics), and the file the JSON log line is appended to (stderr if unset)
+METRICS_ENABLED = os.environ.get('COVID_METRICS', '') not in ('', '0')
+METRICS_LOG = os.environ.get('COVID_METRICS_LOG')
+
+# static dashboard: output folder, and worker processes (None for one per core)
+EXPORT_DIR = "dashboard"
+EXPORT_WORKERS = None
+
+COUNTRIES_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "countries.csv")
+API_KEY_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rapidapi_key.txt")
+
+
+################## instrumentation ##############################
+class Metrics:
+    '''Stage timings and counters, collected while METRICS_ENABLED is set
+    and exported as JSON or in the Prometheus text format.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.counters = defaultdict(float)
+
+    def observe(self, stage, seconds):
+        '''Records one timed run of a stage.'''
+        with self.lock:
+            span = self.spans.setdefault(stage, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += seconds
+            span[2] = max(span[2], seconds)
+
+    def add(self, name, value=1, **labels):
+        '''Adds to a counter, e.g. add("covid_cache_requests_total", result="hit").'''
+        with self.lock:
+            self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def as_dict(self):
+        '''Returns the spans and counters as plain data for a JSON log line.'''
+        with self.lock:
+            return {
+                'spans': {
+                    stage: {'count': n, 'seconds': round(total, 6), 'max_seconds': round(longest, 6)}
+                    for stage, (n, total, longest) in self.spans.items()
+                },
+                'counters': {
+                    name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else ""): value
+                    for (name, labels), value in self.counters.items()
+                },
+            }
+
+    def prometheus_text(self):
+        '''Renders the spans and counters in the Prometheus text format.'''
+        def sample(name, labels, value):
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            return f"{name}{{{label_text}}} {value:g}" if labels else f"{name} {value:g}"
+
+        with self.lock:
+            lines = []
+            for name, kind, field in (('covid_stage_calls_total', 'counter', 0),
+                                      ('covid_stage_seconds_total', 'counter', 1),
+                                      ('covid_stage_max_seconds', 'gauge', 2)):
+                lines.append(f"# TYPE {name} {kind}")
+                lines += [sample(name, (('stage', stage),), span[field]) for stage, span in sorted(self.spans.items())]
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(sample(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+NO_SPAN = contextlib.nullcontext()
+
+
+class Span:
+    '''Times the block it wraps as one run of a stage.'''
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        METRICS.observe(self.stage, time.perf_counter() - self.start)
+
+
+def span(stage):
+    '''Returns a context manager timing a block as a stage, or a shared
+    no-op one when metrics are off.'''
+    return Span(stage) if METRICS_ENABLED else NO_SPAN
+
+
+def timed(stage):
+    '''Decorates a function so that each call is timed as a stage. With
+    metrics off the only cost is one flag check per call.'''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS_ENABLED:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                METRICS.observe(stage, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1, **labels):
+    '''Adds to a counter when metrics are on.'''
+    if METRICS_ENABLED:
+        METRICS.add(name, value, **labels)
+
+
+# where progress messages go in the current thread or task; the refresher
+# points it at stderr so its polls don't print over the menu's prompts
+PROGRESS_OUTPUT = contextvars.ContextVar('progress_output', default=None)
+
+
+def progress(message):
+    '''Prints a progress message to the current PROGRESS_OUTPUT, or stdout.'''
+    print(message, file=PROGRESS_OUTPUT.get() or sys.stdout)
+
+
+def log_metrics():
+    '''Writes the collected metrics as one JSON line to METRICS_LOG, or to
+    stderr if it isn't set.'''
+    line = json.dumps(dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), **METRICS.as_dict()))
+    if METRICS_LOG:
+        with open(METRICS_LOG, 'a', encoding='utf-8') as log_file:
+            log_file.write(line + "\n")
+    else:
+        print(line, file=sys.stderr)
+
+
+########### data gathering and sorting #################
+# the population table's fields, each with a word that identifies its column
+# in the article's header row, in the order the columns usually come
+POPULATION_HEADERS = [
+    ('country', 'country'),
+    ('UN continental region', 'continental'),
+    ('UN statistical region', 'statistical'),
+    ('2018 population', '2018'),
+    ('2019 population', '2019'),
+    ('percentage population change', 'change'),
+]
+
+# the fields of a population record, as keyed under its country name
+POPULATION_FIELDS = [field for field, _ in POPULATION_HEADERS[1:]]
+
+
+def population_columns(headers):
+    '''Finds each population field's column from the table's header cells,
+    falling back to its usual position when no header names it.
+
+    params
+    ------
+    headers : list
+        the text of the header row's cells
+
+    returns
+    -------
+    dict
+        each field in POPULATION_HEADERS mapped to a cell index
+    '''
+    headers = [header.casefold() for header in headers]
+    return {
+        field: next((i for i, header in enumerate(headers) if word in header), position)
+        for position, (field, word) in enumerate(POPULATION_HEADERS)
+    }
+
+
+class PopulationTableParser(HTMLParser):
+    '''Streaming parser for the first sortable table of the UN population article.
+
+    Rather than building a tree of the whole page, it only tracks the tags it
+    needs and turns every row of the table body into a record as soon as the
+    row ends. Once the table body has been consumed `done` is set and the rest
+    of the page can be skipped.
+
+    Attributes
+    ----------
+    records : dict
+        countries organized by their population data
+    done : bool
+        whether the table body has been fully read
+    columns : dict
+        where each field sits in a row, read from the header row rather
+        than assumed, so reordered or added columns don't break the parse
+    '''
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.records = {}
+        self.done = False
+        self.table_depth = 0 # 1 while directly inside the target table
+        self.columns = None # field -> cell index, from the header row
+        self.cells = None
+        self.cell_text = None
+        self.header_row = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'table':
+            if self.table_depth:
+                self.table_depth += 1
+            elif 'sortable' in (dict(attrs).get('class') or '').split():
+                self.table_depth = 1
+        elif self.table_depth == 1:
+            if tag == 'tr':
+                self._end_row()
+                self.cells = []
+                self.header_row = False
+            elif tag in ('td', 'th') and self.cells is not None:
+                self._end_cell()
+                self.header_row = self.header_row or tag == 'th'
+                self.cell_text = []
+
+    def handle_endtag(self, tag):
+        if self.done or not self.table_depth:
+            return
+        if tag == 'table':
+            self.table_depth -= 1
+            if self.table_depth == 0:
+                self._end_row()
+                self.done = True
+        elif self.table_depth == 1:
+            if tag in ('td', 'th'):
+                self._end_cell()
+            elif tag == 'tr':
+                self._end_row()
+            elif tag == 'tbody':
+                self._end_row()
+                self.done = True
+
+    def handle_data(self, data):
+        if self.cell_text is not None:
+            self.cell_text.append(data)
+
+    def _end_cell(self):
+        if self.cell_text is not None:
+            self.cells.append("".join(self.cell_text).strip())
+        self.cell_text = None
+
+    def _end_row(self):
+        if self.cells is None:
+            return
+        self._end_cell()
+        cells, self.cells = self.cells, None
+        if self.header_row:
+            if self.columns is None:
+                self.columns = population_columns(cells)
+            return
+        columns = self.columns or population_columns([])
+        if len(cells) <= max(columns.values()): # empty elements
+            return
+
+        # clean the wikipedia notation off of the names
+        country_name = cells[columns['country']].split("[")[0].strip()
+        try:
+            pop_2018 = int(cells[columns['2018 population']].replace(',', ''))
+            pop_2019 = int(cells[columns['2019 population']].replace(',', ''))
+        except ValueError:
+            return
+
+        self.records[country_name] = {
+            'UN continental region': cells[columns['UN continental region']],
+            'UN statistical region': cells[columns['UN statistical region']],
+            '2018 population': pop_2018,
+            '2019 population': pop_2019,
+            'percentage population change': cells[columns['percentage population change']]
+        }
+
+
+@timed('parse_population')
+def parse_population_table(html):
+    '''Extracts the population table from the UN population article.
+
+    The page is fed to the parser in chunks and parsing stops as soon as the
+    table body has been read, so the rest of the article is never looked at.
+
+    params
+    ------
+    html : str
+        the article's html
+
+    returns
+    -------
+    dict
+        countries organized by their population data
+    '''
+    parser = PopulationTableParser()
+    for start in range(0, len(html), PARSE_CHUNK_SIZE):
+        parser.feed(html[start:start + PARSE_CHUNK_SIZE])
+        if parser.done:
+            break
+    return parser.records
+
+
+def scrape_wiki_data():
+    '''Parses wikipedia page for table contents.
+
+    params
+    ------
+    none
+
+    returns
+    -------
+    dict
+        countries organized by their population data
+    '''
+    return parse_population_table(make_request_with_cache(wikipedia_url, allow_stale=False))
+
+
+def get_api_key():
+    '''Returns the RapidAPI key: the RAPIDAPI_KEY environment variable, or
+    the contents of the rapidapi_key.txt next to this script.
+
+    The key is kept in a plain text file rather than a secrets.py, which
+    would shadow the standard library's secrets module for every library
+    imported from this folder. It is only looked up when a request is
+    actually sent to the covid API, so queries and cached data work without
+    one.
+
+    returns
+    -------
+    str
+        the key
+
+    raises
+    ------
+    RuntimeError
+        if no key is configured
+    '''
+    global API_KEY
+    if API_KEY is None and os.path.exists(API_KEY_FILENAME):
+        with open(API_KEY_FILENAME, encoding='utf-8') as f:
+            API_KEY = f.read().strip() or None
+    if API_KEY is None:
+        raise RuntimeError("No RapidAPI key: set RAPIDAPI_KEY or put the key in rapidapi_key.txt")
+    return API_KEY
+
+
+def make_request(base_url, allow_stale=True, max_age=None, timeout=None):
+    '''Calls the rapid api and returns a json 
+    of coronavirus cases by country and by continent and even a cruise ship.
+
+    parameters
+    ----------
+    base_url : str
+        the url used to call the api
+    allow_stale : bool
+        see make_request_with_cache
+    max_age : float
+        see make_request_with_cache
+    timeout : float
+        see make_request_with_cache
+
+    returns
+    -------
+    dict
+        a dictionary of countries and continents
+    '''
+    querystring = {"country" : "United States"}
+    # the key is only looked up if the cache can't answer
+    headers = {
+        'x-rapidapi-host' : "covid-193.p.rapidapi.com",
+        'x-rapidapi-key' : get_api_key
+    }
+
+    return make_request_with_cache(base_url, headers=headers, as_json=True,
+                                   allow_stale=allow_stale, max_age=max_age, timeout=timeout)
+
+
+# the count columns produced by create_covid_cases_columns, in table order
+CASES_COUNT_COLUMNS = ['new cases', 'active cases', 'new deaths', 'total cases', 'total deaths']
+
+
+def clean_country_name(name):
+    '''Applies the API name fixes the rest of the script has always relied on.'''
+    if name == "USA":
+        return "United States"
+    if name == "S-Korea":
+        return "South Korea"
+    return name.replace("-", " ")
+
+
+@timed('parse_cases')
+def create_covid_cases_columns(covid_json):
+    '''Turns the covid API response into typed columns in a single pass.
+
+    Counts are int64 masked arrays: a figure the API left out is masked
+    rather than replaced by 0, and the "+" prefix on new cases and deaths is
+    parsed away instead of being kept as a string.
+
+    Only the output is columnar. The rows are nested dicts, so reading them
+    is a Python loop either way; one pass into lists beats a np.fromiter
+    per field, which walks every row again for each column.
+
+    params
+    ------
+    covid_json : dict
+        the response from make_request(covid_url)
+
+    returns
+    -------
+    dict
+        'country' and 'day' object arrays, plus a numpy.ma.MaskedArray
+        per count ('new cases', 'active cases', 'new deaths', 'total cases',
+        'total deaths'), all in the API's row order
+    '''
+    import numpy as np
+
+    all_countries = covid_json['response']
+    n = len(all_countries)
+    today = time.strftime('%Y-%m-%d', time.gmtime())
+
+    countries = [None] * n
+    days = [None] * n
+    new_cases = [NULL_COUNT] * n
+    active_cases = [NULL_COUNT] * n
+    new_deaths = [NULL_COUNT] * n
+    total_cases = [NULL_COUNT] * n
+    total_deaths = [NULL_COUNT] * n
+
+    for i, country in enumerate(all_countries):
+        cases = country['cases']
+        countries[i] = clean_country_name(country['country'])
+        days[i] = country.get('day') or today
+
+        # new figures come as "+123" strings
+        value = cases['new']
+        if value is not None:
+            new_cases[i] = int(value)
+        value = cases['active']
+        if value is not None:
+            active_cases[i] = value
+        value = country['deaths']['new']
+        if value is not None:
+            new_deaths[i] = int(value)
+        value = cases['total']
+        if value is not None:
+            total_cases[i] = value
+        value = country['deaths']['total']
+        if value is not None:
+            total_deaths[i] = value
+
+    columns = {
+        'country': np.array(countries, dtype=object),
+        'day': np.array(days, dtype=object),
+    }
+    for column, values in zip(CASES_COUNT_COLUMNS, (new_cases, active_cases, new_deaths, total_cases, total_deaths)):
+        columns[column] = np.ma.masked_equal(np.array(values, dtype=np.int64), NULL_COUNT, copy=False)
+    return columns
+
+
+###################### caching ##########################
+class CacheStore:
+    '''An append-only, on-disk cache with one record per entry.
+
+    Every write appends a single record (a json header line followed by the
+    json encoded value) and flushes it, so a write costs only the size of the
+    changed entry and a crash can at worst lose the record being written.
+    Records that were cut off or fail their checksum are truncated away the
+    next time the log is opened. Overwritten and evicted entries are dropped
+    when the log is compacted into a fresh file and renamed over the old one.
+
+    Opening the store only reads a small key -> offset index written next to
+    the log (plus any records appended after it was saved). Values are decoded
+    from a memory map of the log the first time they are accessed.
+
+    Several processes can share one log (the menu beside a refresher, or
+    overlapping cron runs): every access takes an exclusive lock on the log
+    file and first replays the records other processes appended since, or
+    reopens the log if one of them compacted it, so offsets always come from
+    the file itself.
+
+    Attributes
+    ----------
+    filename : str
+        path of the log file
+    index_filename : str
+        path of the key -> offset index
+    max_bytes : int
+        live size above which least recently used entries are evicted
+    '''
+    def __init__(self, filename, max_bytes=CACHE_MAX_BYTES):
+        self.filename = filename
+        self.index_filename = filename + ".idx"
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.entries = OrderedDict() # key -> (body offset, body length, record size), least recently used first
+        self.values = {} # decoded values, filled on first access
+        self.live_bytes = 0
+        self.file_bytes = 0
+        self.map = None
+        self.log = None
+        self._reopen()
+        self._sync()
+
+    def _reopen(self):
+        '''Opens the log at its path afresh and loads the saved index, if it
+        describes that file.'''
+        if self.log is not None:
+            self._unmap()
+            self.log.close()
+        self.entries.clear()
+        self.values.clear()
+        self.live_bytes = 0
+        self.log = open(self.filename, 'a+b')
+        self.file_bytes = self._load_index(os.fstat(self.log.fileno()))
+
+    @contextlib.contextmanager
+    def _locked(self):
+        '''Holds the log exclusively, across threads and processes, after
+        catching up with whatever other processes did to it.'''
+        with self.lock:
+            if fcntl is not None:
+                while True:
+                    fcntl.flock(self.log.fileno(), fcntl.LOCK_EX)
+                    try:
+                        if os.stat(self.filename).st_ino == os.fstat(self.log.fileno()).st_ino:
+                            break
+                    except FileNotFoundError:
+                        pass
+                    # another process compacted the log into a new file
+                    fcntl.flock(self.log.fileno(), fcntl.LOCK_UN)
+                    self._reopen()
+            try:
+                self._catch_up()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.log.fileno(), fcntl.LOCK_UN)
+
+    def _sync(self):
+        '''Brings this process's view of the log up to date.'''
+        with self._locked():
+            pass
+
+    def _catch_up(self):
+        '''Replays the records appended to the log after the ones already
+        known, truncating a torn or corrupt tail.'''
+        offset = self.file_bytes
+        size = os.fstat(self.log.fileno()).st_size
+        if offset == size:
+            return
+        if offset > size:
+            # the log shrank under us: start over from the file
+            self._reopen()
+            offset = self.file_bytes
+
+        data = self._mapped(size)
+        while offset < len(data):
+            record = self._parse_header(data, offset)
+            if record is None:
+                break
+            key, body_offset, body_length, crc, deleted, end = record
+            if zlib.crc32(data[body_offset:body_offset + body_length]) != crc:
+                break
+            self._forget(key)
+            if not deleted:
+                self.entries[key] = (body_offset, body_length, end - offset)
+                self.live_bytes += end - offset
+            offset = end
+
+        if offset < len(data):
+            progress(f"[Error] Dropping {len(data) - offset} corrupt bytes from the end of {self.filename}")
+            self._unmap()
+            self.log.truncate(offset)
+        self.file_bytes = offset
+
+    def _load_index(self, log_stat):
+        '''Loads the index if it describes this log file, returning the log
+        offset it covers (0 if there is no usable index).'''
+        try:
+            with open(self.index_filename, 'r') as f:
+                index = json.load(f)
+            if index['inode'] != log_stat.st_ino or index['log_bytes'] > log_stat.st_size:
+                return 0
+            for key, body_offset, body_length, size in index['entries']:
+                self.entries[key] = (body_offset, body_length, size)
+                self.live_bytes += size
+            return index['log_bytes']
+        except (OSError, ValueError, KeyError, TypeError):
+            self.entries.clear()
+            self.live_bytes = 0
+            return 0
+
+    def save_index(self):
+        '''Atomically writes the key -> offset index for the whole log, taking
+        in what other processes appended.'''
+        with self._locked():
+            self._write_index()
+
+    def _write_index(self):
+        index = {
+            'inode': os.fstat(self.log.fileno()).st_ino,
+            'log_bytes': self.file_bytes,
+            'entries': [[k] + list(v) for k, v in self.entries.items()],
+        }
+        tmp_filename = f"{self.index_filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_filename, self.index_filename)
+
+    @staticmethod
+    def _parse_header(data, offset):
+        '''Decodes the header of the record starting at offset, or returns None
+        if the record is incomplete.'''
+        newline = data.find(b"\n", offset)
+        if newline == -1:
+            return None
+        try:
+            header = json.loads(data[offset:newline])
+            body_offset = newline + 1
+            end = body_offset + header['n'] + 1
+            if end > len(data):
+                return None
+            return header['k'], body_offset, header['n'], header['c'], header.get('d', False), end
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def _mapped(self, size=None):
+        '''Returns a memory map of the open log covering at least size bytes
+        (the known records by default), remapping after appends.'''
+        size = self.file_bytes if size is None else size
+        if self.map is None or len(self.map) < size or size == 0:
+            self._unmap()
+            size = os.fstat(self.log.fileno()).st_size
+            if size == 0:
+                return b""
+            self.map = mmap.mmap(self.log.fileno(), size, access=mmap.ACCESS_READ)
+        return self.map
+
+    def _unmap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def _append(self, key, value=None, deleted=False):
+        '''Writes one record to the end of the log and returns its body offset,
+        body length and record size.'''
+        body = b"" if deleted else json.dumps(value).encode('utf-8')
+        header = {'k': key, 'n': len(body), 'c': zlib.crc32(body)}
+        if deleted:
+            header['d'] = True
+        header_line = json.dumps(header).encode('utf-8') + b"\n"
+        record = header_line + body + b"\n"
+        # called with the log locked and caught up, so the end of the file is
+        # where this record lands
+        offset = os.fstat(self.log.fileno()).st_size
+        self.log.write(record)
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.file_bytes = offset + len(record)
+        return offset + len(header_line), len(body), len(record)
+
+    def _forget(self, key):
+        if key in self.entries:
+            self.live_bytes -= self.entries.pop(key)[2]
+        self.values.pop(key, None)
+
+    def __contains__(self, key):
+        with self._locked():
+            return key in self.entries
+
+    def __len__(self):
+        with self._locked():
+            return len(self.entries)
+
+    def __getitem__(self, key):
+        with self._locked():
+            body_offset, body_length, _ = self.entries[key]
+            self.entries.move_to_end(key)
+            if key not in self.values:
+                data = self._mapped()
+                self.values[key] = json.loads(data[body_offset:body_offset + body_length])
+            return self.values[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        with self._locked():
+            return list(self.entries.keys())
+
+    def __setitem__(self, key, value):
+        with self._locked():
+            location = self._append(key, value)
+            self._forget(key)
+            self.entries[key] = location
+            self.values[key] = value
+            self.live_bytes += location[2]
+            self._evict()
+
+    def __delitem__(self, key):
+        with self._locked():
+            if key not in self.entries:
+                raise KeyError(key)
+            self._append(key, deleted=True)
+            self._forget(key)
+
+    def _evict(self):
+        '''Drops least recently used entries until the live size fits max_bytes.
+        The newest entry is always kept.'''
+        while self.live_bytes > self.max_bytes and len(self.entries) > 1:
+            key = next(iter(self.entries))
+            self._append(key, deleted=True)
+            self._forget(key)
+
+    def needs_compaction(self):
+        self._sync()
+        dead_bytes = self.file_bytes - self.live_bytes
+        return dead_bytes > CACHE_COMPACT_MIN_BYTES and dead_bytes > self.live_bytes
+
+    def compact(self):
+        '''Rewrites the live entries into a new log, atomically renames it
+        over the old one and saves a fresh index.'''
+        with self._locked():
+            data = self._mapped()
+            tmp_filename = f"{self.filename}.{os.getpid()}.tmp"
+            old_log = self.log
+            self.log = open(tmp_filename, 'wb')
+            self.file_bytes = 0
+            self.live_bytes = 0
+            entries = self.entries
+            self.entries = OrderedDict()
+            for key, (body_offset, body_length, _) in entries.items():
+                body = data[body_offset:body_offset + body_length]
+                header_line = json.dumps({'k': key, 'n': body_length, 'c': zlib.crc32(body)}).encode('utf-8') + b"\n"
+                self.log.write(header_line + body + b"\n")
+                size = len(header_line) + body_length + 1
+                self.entries[key] = (self.file_bytes + len(header_line), body_length, size)
+                self.file_bytes += size
+                self.live_bytes += size
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.log.close()
+            self._unmap()
+            # other processes notice the new file once they get the lock,
+            # which is only released when the old log is closed
+            os.replace(tmp_filename, self.filename)
+            self.log = open(self.filename, 'a+b')
+            self._write_index()
+            old_log.close()
+
+    def close(self):
+        '''Saves the index so the next open doesn't have to replay the log.'''
+        with self._locked():
+            self._write_index()
+            self._unmap()
+        self.log.close()
+
+
+def open_cache():
+    ''' Opens the cache log if it exists and loads its index into
+    the CACHE_DICT store (entries are decoded when first used).
+    if the cache file doesn't exist, creates a new, empty store
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    CacheStore
+        the opened cache
+    '''
+    cache = CacheStore(CACHE_FILENAME)
+    atexit.register(cache.close)
+    return cache
+
+
+def save_cache(cache_dict):
+    ''' Makes sure the current state of the cache is on disk.
+
+    Entries are written to the log as they are set, so this only compacts
+    the log once most of it is overwritten or evicted records.
+
+    Parameters
+    ----------
+    cache_dict: CacheStore
+        The cache to save
+
+    Returns
+    -------
+    None
+    '''
+    if isinstance(cache_dict, CacheStore) and cache_dict.needs_compaction():
+        cache_dict.compact()
+
+
+def get_session():
+    '''Returns the pooled requests session shared by every source,
+    creating it on first use so connections are kept alive between fetches.
+
+    Returns
+    -------
+    requests.Session
+        the shared session
+    '''
+    global SESSION
+    with CACHE_LOCK:
+        if SESSION is None:
+            import requests
+            import requests.adapters
+            SESSION = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+            SESSION.mount("https://", adapter)
+            SESSION.mount("http://", adapter)
+    return SESSION
+
+
+def http_get(url, headers=None, params=None, timeout=None):
+    '''Sends a GET through the shared session, timed under the fetch span and
+    counted by host and status, with the bytes received.
+
+    Parameters
+    ----------
+    url : str
+        the url to fetch
+    headers : dict
+        request headers
+    params : dict
+        query string parameters
+    timeout : float
+        seconds to wait on the server (REQUEST_TIMEOUT)
+
+    Returns
+    -------
+    requests.Response
+        the response, whatever its status
+    '''
+    with span('fetch'):
+        response = get_session().get(url, headers=headers, params=params,
+                                     timeout=REQUEST_TIMEOUT if timeout is None else timeout)
+    host = urllib.parse.urlsplit(url).netloc
+    count('covid_http_responses_total', host=host, status=response.status_code)
+    count('covid_fetched_bytes_total', len(response.content), host=host)
+    return response
+
+
+def revalidate(url, headers=None, as_json=False, timeout=None):
+    '''Fetches a url, sending If-None-Match/If-Modified-Since when a cached
+    copy exists, and stores the result in the cache.
+
+    A 304 response only refreshes the cached entry's timestamp.
+
+    Parameters
+    ----------
+    url : str
+        the url to fetch, also used as the cache key
+    headers : dict
+        extra request headers (e.g. the api key); a value may be a function,
+        called only now that a request is being sent
+    as_json : bool
+        decode the body as json instead of text
+    timeout : float
+        seconds to wait on the server (REQUEST_TIMEOUT)
+
+    Returns
+    -------
+    dict or str
+        the response body
+    '''
+    request_headers = {name: value() if callable(value) else value for name, value in (headers or {}).items()}
+    entry = CACHE_DICT.get(url)
+    if not is_cache_entry(entry):
+        entry = None
+    if entry is not None:
+        if entry.get('etag'):
+            request_headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            request_headers['If-Modified-Since'] = entry['last_modified']
+
+    response = http_get(url, headers=request_headers, timeout=timeout)
+
+    if response.status_code == 304 and entry is not None:
+        entry = dict(entry, fetched_at=time.time())
+    else:
+        response.raise_for_status()
+        entry = {
+            'body': response.json() if as_json else response.text,
+            'fetched_at': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+
+    with CACHE_LOCK, span('cache'):
+        CACHE_DICT[url] = entry
+        save_cache(CACHE_DICT)
+    return entry['body']
+
+
+def revalidate_in_background(url, headers=None, as_json=False):
+    '''Starts a daemon thread that revalidates a stale cache entry,
+    unless one is already running for that url.
+
+    Parameters
+    ----------
+    url : str
+        the url to refresh
+    headers : dict
+        extra request headers
+    as_json : bool
+        decode the body as json instead of text
+
+    Returns
+    -------
+    None
+    '''
+    with CACHE_LOCK:
+        if url in REVALIDATING:
+            return
+        REVALIDATING.add(url)
+
+    def refresh():
+        try:
+            revalidate(url, headers, as_json)
+        except Exception as e:
+            progress(f"[Error] Background refresh of {url} failed: {e}")
+        finally:
+            with CACHE_LOCK:
+                REVALIDATING.discard(url)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def is_cache_entry(entry):
+    '''Checks whether a cached value was written by the fetch layer
+    (older caches stored bare response bodies).
+    '''
+    return isinstance(entry, dict) and 'body' in entry and 'fetched_at' in entry
+
+
+def make_request_with_cache(url, headers=None, as_json=False, allow_stale=True, max_age=None, timeout=None):
+    '''Issues a request through the cache saved to the device.
+
+    If the cached copy is younger than the url's TTL it is returned without
+    touching the network. If it is past the TTL but within the stale window
+    it is returned immediately and refreshed in the background. Otherwise the
+    url is fetched with a conditional request, so an unchanged page costs a 304.
+
+    Refreshes and one-shot runs pass allow_stale=False, since a background
+    refresh would land after the stale copy was loaded (or die with the
+    process), and max_age=0 to check with the server on every call.
+
+    Parameters
+    ----------
+    url : str
+        the url to fetch, also used as the cache key
+    headers : dict
+        extra request headers
+    as_json : bool
+        decode the body as json instead of text
+    allow_stale : bool
+        serve a stale copy while revalidating in the background
+    max_age : float
+        seconds a cached copy may be used without asking the server; the
+        url's TTL by default
+    timeout : float
+        seconds to wait on the server when the url is fetched (REQUEST_TIMEOUT)
+
+    Returns
+    -------
+    dict or str
+        the response body
+    '''
+    entry = CACHE_DICT.get(url)
+
+    if is_cache_entry(entry):
+        age = time.time() - entry['fetched_at']
+        ttl = CACHE_TTL.get(url, DEFAULT_CACHE_TTL) if max_age is None else max_age
+        stale_ttl = CACHE_STALE_TTL.get(url, DEFAULT_CACHE_STALE_TTL)
+        if age < ttl:
+            progress("Using cache")
+            count('covid_cache_requests_total', result='hit')
+            return entry['body']
+        if allow_stale and age < ttl + stale_ttl:
+            progress("Using cache (refreshing in background)")
+            count('covid_cache_requests_total', result='stale')
+            revalidate_in_background(url, headers, as_json)
+            return entry['body']
+
+    progress("Fetching")
+    count('covid_cache_requests_total', result='miss')
+    return revalidate(url, headers, as_json, timeout)
+
+
+##################### database ##########################
+COUNTRIES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "Countries" (
+        "Id" INTEGER PRIMARY KEY AUTOINCREMENT,
+        "Name" TEXT NOT NULL UNIQUE,
+        "IsoCode" TEXT NULL UNIQUE,
+        "Kind" TEXT NULL
+    )
+'''
+
+# every spelling of a country we have seen, reduced with normalize_country_key
+COUNTRY_ALIASES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "CountryAliases" (
+        "Key" TEXT PRIMARY KEY,
+        "CountryId" INTEGER NOT NULL REFERENCES Countries(Id)
+    ) WITHOUT ROWID
+'''
+
+CASES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "{table}" (
+        "Id" INTEGER PRIMARY KEY AUTOINCREMENT,
+        "CountryId" INTEGER NOT NULL REFERENCES Countries(Id),
+        "Country" TEXT NOT NULL,
+        "NewCases" INTEGER NULL,
+        "ActiveCases" INTEGER NULL,
+        "NewDeaths" INTEGER NULL,
+        "TotalCases" INTEGER NULL,
+        "TotalDeaths" INTEGER NULL,
+        "RowHash" INTEGER NOT NULL
+    )
+'''
+
+POPULATION_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "{table}" (
+        "Id" INTEGER PRIMARY KEY AUTOINCREMENT,
+        "CountryId" INTEGER NOT NULL REFERENCES Countries(Id),
+        "Country" TEXT NOT NULL,
+        "UNContinentalRegion" TEXT NOT NULL,
+        "UNStatisticalRegion" TEXT NOT NULL,
+        "2018population" INTEGER NOT NULL,
+        "2019population" INTEGER NOT NULL,
+        "PopulationChange" TEXT NOT NULL,
+        "RowHash" INTEGER NOT NULL
+    )
+'''
+
+# the columns of the snapshot tables, without the Id
+CASES_COLUMNS = ["CountryId", "Country", "NewCases", "ActiveCases", "NewDeaths", "TotalCases", "TotalDeaths", "RowHash"]
+POPULATION_COLUMNS = ["CountryId", "Country", "UNContinentalRegion", "UNStatisticalRegion",
+    "2018population", "2019population", "PopulationChange", "RowHash"]
+
+# per-capita figures derived from Cases and Population, kept up to date by
+# the loaders so rankings are a single indexed read
+COUNTRY_METRICS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "CountryMetrics" (
+        "CountryId" INTEGER PRIMARY KEY REFERENCES Countries(Id),
+        "Country" TEXT NOT NULL,
+        "Population" INTEGER NOT NULL,
+        "CasesPerCapita" REAL NULL,
+        "DeathsPerMillion" REAL NULL,
+        "ActiveRatio" REAL NULL,
+        "AnnualPopulationGrowth" REAL NULL,
+        "AdjustedCasesPerCapita" REAL NULL
+    )
+'''
+
+# the rankable metrics, by the names used on the command line
+METRIC_COLUMNS = {
+    'cases_per_capita': "CasesPerCapita",
+    'deaths_per_million': "DeathsPerMillion",
+    'active_ratio': "ActiveRatio",
+    'adjusted_cases_per_capita': "AdjustedCasesPerCapita",
+}
+
+COUNTRY_METRICS_INDEXES_SQL = [
+    f'CREATE INDEX IF NOT EXISTS "idx_CountryMetrics_{column}" ON "CountryMetrics" ("{column}" DESC)'
+    for column in METRIC_COLUMNS.values()
+]
+
+METRICS_SOURCE_SQL = '''
+    SELECT c.CountryId, c.Country, p."2019population", c.TotalCases, c.TotalDeaths, c.ActiveCases,
+        p.PopulationChange
+    FROM Cases c
+    JOIN Population p ON p.CountryId = c.CountryId
+    WHERE c.CountryId IN (SELECT value FROM json_each(:ids)) OR :ids IS NULL
+'''
+
+# mid-year date the 2019 population estimates refer to
+POPULATION_ESTIMATE_DATE = datetime.date(2019, 7, 1)
+
+# small key/value store for bookkeeping such as source content hashes
+META_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "Meta" (
+        "Key" TEXT PRIMARY KEY,
+        "Value" TEXT NULL
+    ) WITHOUT ROWID
+'''
+
+COUNTRY_BY_KEY_SQL = '''
+    SELECT c.Id, c.Name
+    FROM CountryAliases a
+    JOIN Countries c ON c.Id = a.CountryId
+    WHERE a.Key = ?
+'''
+
+# one row per country per day (or per week, for rolled up history); the
+# primary key doubles as the covering index for "last N days of country X"
+CASES_HISTORY_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "CasesHistory" (
+        "CountryId" INTEGER NOT NULL REFERENCES Countries(Id),
+        "Day" TEXT NOT NULL,
+        "Granularity" TEXT NOT NULL DEFAULT 'day',
+        "NewCases" INTEGER NULL,
+        "ActiveCases" INTEGER NULL,
+        "NewDeaths" INTEGER NULL,
+        "TotalCases" INTEGER NULL,
+        PRIMARY KEY ("CountryId", "Day")
+    ) WITHOUT ROWID
+'''
+
+# only rewrites a day's row when one of its figures changed, and skips days
+# whose week has already been rolled up, so reloading a long archive neither
+# overwrites a week nor leaves stray days to be rolled into it again
+UPSERT_HISTORY_SQL = '''
+    INSERT INTO CasesHistory (CountryId, Day, Granularity, NewCases, ActiveCases, NewDeaths, TotalCases)
+    SELECT ?1, ?2, 'day', ?3, ?4, ?5, ?6
+    WHERE NOT EXISTS (
+        SELECT 1 FROM CasesHistory
+        WHERE CountryId = ?1 AND Day = date(?2, '-6 days', 'weekday 1') AND Granularity = 'week'
+    )
+    ON CONFLICT (CountryId, Day) DO UPDATE SET
+        NewCases = excluded.NewCases,
+        ActiveCases = excluded.ActiveCases,
+        NewDeaths = excluded.NewDeaths,
+        TotalCases = excluded.TotalCases
+    WHERE Granularity = 'day' AND (
+        NewCases IS NOT excluded.NewCases OR
+        ActiveCases IS NOT excluded.ActiveCases OR
+        NewDeaths IS NOT excluded.NewDeaths OR
+        TotalCases IS NOT excluded.TotalCases
+    )
+'''
+
+# rolls daily rows before the cutoff into one row per week, keyed on the
+# week's Monday: new cases and deaths are summed, active and total cases are
+# taken from the last day of the week (sqlite returns the bare columns of
+# the MAX(Day) row)
+DOWNSAMPLE_HISTORY_SQL = '''
+    INSERT INTO CasesHistory (CountryId, Day, Granularity, NewCases, ActiveCases, NewDeaths, TotalCases)
+    SELECT CountryId, Week, 'week', NewCases, ActiveCases, NewDeaths, TotalCases
+    FROM (
+        SELECT CountryId, date(Day, '-6 days', 'weekday 1') AS Week, MAX(Day),
+            SUM(NewCases) AS NewCases, ActiveCases, SUM(NewDeaths) AS NewDeaths, TotalCases
+        FROM CasesHistory
+        WHERE Granularity = 'day' AND Day < :cutoff
+        GROUP BY CountryId, Week
+    ) WHERE true
+    ON CONFLICT (CountryId, Day) DO UPDATE SET
+        Granularity = 'week',
+        NewCases = excluded.NewCases,
+        ActiveCases = excluded.ActiveCases,
+        NewDeaths = excluded.NewDeaths,
+        TotalCases = excluded.TotalCases
+'''
+
+# one row per API country name, so an interrupted backfill can resume
+BACKFILL_CHECKPOINTS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS "BackfillCheckpoints" (
+        "Country" TEXT PRIMARY KEY,
+        "Status" TEXT NOT NULL,
+        "Rows" INTEGER NULL,
+        "Error" TEXT NULL,
+        "UpdatedAt" TEXT NOT NULL
+    )
+'''
+
+UPSERT_CHECKPOINT_SQL = '''
+    INSERT INTO BackfillCheckpoints (Country, Status, Rows, Error, UpdatedAt)
+    VALUES (?, ?, ?, ?, datetime('now'))
+    ON CONFLICT (Country) DO UPDATE SET
+        Status = excluded.Status,
+        Rows = excluded.Rows,
+        Error = excluded.Error,
+        UpdatedAt = excluded.UpdatedAt
+'''
+
+CASES_INDEXES_SQL = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS "idx_Cases_CountryId" ON "Cases" ("CountryId")',
+]
+
+POPULATION_INDEXES_SQL = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS "idx_Population_CountryId" ON "Population" ("CountryId")',
+]
+
+
+def connect_db():
+    ''' Opens a connection to the SQL database in WAL mode, so readers
+    keep seeing the last committed data while a load is running.
+
+    Transactions are managed explicitly (BEGIN/COMMIT) by the callers.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    sqlite3.Connection
+        the open connection
+    '''
+    conn = sqlite3.connect(DB_NAME, timeout=30, isolation_level=None, cached_statements=256)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def create_db():
+    ''' Create a SQL database if it doesn't already exist, along with empty tables.
+    Existing data is left in place; the loaders replace it atomically.
+    
+    Parameters
+    ----------
+    None
+    
+    Returns
+    -------
+    None
+    '''
+    conn = connect_db()
+    conn.execute(COUNTRIES_TABLE_SQL)
+    conn.execute(COUNTRY_ALIASES_TABLE_SQL)
+    conn.execute(META_TABLE_SQL)
+    ensure_snapshot_table(conn, "Cases", CASES_TABLE_SQL, CASES_COLUMNS)
+    ensure_snapshot_table(conn, "Population", POPULATION_TABLE_SQL, POPULATION_COLUMNS)
+    conn.execute(CASES_HISTORY_TABLE_SQL)
+    conn.execute(BACKFILL_CHECKPOINTS_TABLE_SQL)
+    conn.execute(COUNTRY_METRICS_TABLE_SQL)
+    for index_sql in CASES_INDEXES_SQL + POPULATION_INDEXES_SQL + COUNTRY_METRICS_INDEXES_SQL:
+        conn.execute(index_sql)
+    seed_countries(conn)
+    conn.close()
+
+
+def ensure_snapshot_table(conn, table, create_sql, columns):
+    '''Creates a snapshot table, recreating it empty if it was made by an
+    older version of the script with different columns. Snapshot tables only
+    hold the latest data from a source, so the next load refills them.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        an open connection
+    table : str
+        the table's name
+    create_sql : str
+        the table's CREATE statement, with a {table} placeholder
+    columns : list
+        the columns the table should have, without the Id
+
+    Returns
+    -------
+    None
+    '''
+    existing = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+    if existing and existing[1:] != columns:
+        conn.execute(f'DROP TABLE "{table}"')
+    conn.execute(create_sql.format(table=table))
+
+
+def get_meta(key, default=None):
+    '''Reads a value from the Meta table.'''
+    row = get_connection().execute('SELECT Value FROM Meta WHERE Key = ?', (key,)).fetchone()
+    return default if row is None else row[0]
+
+
+def set_meta(key, value, conn=None):
+    '''Writes a value to the Meta table, optionally inside the caller's transaction.'''
+    (conn or get_connection()).execute(
+        'INSERT INTO Meta (Key, Value) VALUES (?, ?) ON CONFLICT (Key) DO UPDATE SET Value = excluded.Value',
+        (key, value)
+    )
+
+
+def bump_data_version(conn):
+    '''Marks the data as changed inside the caller's transaction, so that
+    anything cached from the old data (see data_version) is dropped.'''
+    conn.execute(
+        "INSERT INTO Meta (Key, Value) VALUES ('data_version', 1) "
+        "ON CONFLICT (Key) DO UPDATE SET Value = Value + 1"
+    )
+
+
+def normalize_country_key(name):
+    '''Reduces a country name to the key used to look it up, so that
+    spellings from the API, Wikipedia and the user all meet: footnote
+    markers and accents are dropped, case is folded, "&" becomes "and" and
+    punctuation (including the API's dashes) collapses to single spaces.
+
+    Parameters
+    ----------
+    name : str
+        a country name in any spelling
+
+    Returns
+    -------
+    str
+        the lookup key, e.g. "cote d ivoire" for "Côte d'Ivoire[b]"
+    '''
+    name = unicodedata.normalize('NFKD', name.split('[')[0])
+    name = "".join(ch for ch in name if not unicodedata.combining(ch))
+    name = name.casefold().replace('&', ' and ')
+    return " ".join(re.sub(r"[^0-9a-z]+", " ", name).split())
+
+
+def seed_countries(conn):
+    '''Adds the canonical countries, their ISO codes and their known
+    aliases from countries.csv. Rows that already exist are left alone, and
+    nothing is done if the file hasn't changed since it was last seeded.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        an open connection
+
+    Returns
+    -------
+    None
+    '''
+    with open(COUNTRIES_FILENAME, 'rb') as f:
+        data = f.read()
+    file_hash = hashlib.sha1(data).hexdigest()
+    if conn.execute("SELECT 1 FROM Meta WHERE Key = 'countries_hash' AND Value = ?", (file_hash,)).fetchone():
+        return
+    countries = list(csv.DictReader(data.decode('utf-8').splitlines()))
+
+    conn.execute('BEGIN IMMEDIATE')
+    for row in countries:
+        conn.execute(
+            'INSERT OR IGNORE INTO Countries (Name, IsoCode, Kind) VALUES (?, ?, ?)',
+            (row['name'], row['iso3'] or None, row['kind'] or None)
+        )
+        country_id = conn.execute('SELECT Id FROM Countries WHERE Name = ?', (row['name'],)).fetchone()[0]
+        spellings = [row['name'], row['iso3']] + row['aliases'].split('|')
+        conn.executemany(
+            'INSERT OR IGNORE INTO CountryAliases (Key, CountryId) VALUES (?, ?)',
+            [(normalize_country_key(s), country_id) for s in spellings if s]
+        )
+    set_meta('countries_hash', file_hash, conn)
+    bump_data_version(conn)
+    conn.execute('COMMIT')
+
+
+def resolve_countries(names):
+    '''Maps source country names onto the canonical country table.
+
+    Names that match no known alias are added as new countries (without an
+    ISO code) so no rows are lost; they can be merged later by adding an
+    alias to countries.csv.
+
+    Parameters
+    ----------
+    names : iterable of str
+        country names as they appear in a source
+
+    Returns
+    -------
+    dict
+        each name mapped to a (country id, canonical name) tuple
+    '''
+    conn = connect_db()
+    resolved = {}
+    added = False
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        # look each distinct name up once, however often a source repeats it
+        for name in dict.fromkeys(names):
+            key = normalize_country_key(name)
+            row = conn.execute(COUNTRY_BY_KEY_SQL, (key,)).fetchone()
+            if row is None:
+                clean_name = " ".join(name.split('[')[0].replace('-', ' ').split())
+                conn.execute('INSERT OR IGNORE INTO Countries (Name) VALUES (?)', (clean_name,))
+                country_id = conn.execute('SELECT Id FROM Countries WHERE Name = ?', (clean_name,)).fetchone()[0]
+                conn.execute('INSERT OR IGNORE INTO CountryAliases (Key, CountryId) VALUES (?, ?)', (key, country_id))
+                row = conn.execute(COUNTRY_BY_KEY_SQL, (key,)).fetchone()
+                added = True
+            resolved[name] = row
+        if added:
+            bump_data_version(conn)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return resolved
+
+
+@timed('load')
+def bulk_load(table, create_sql, rows, indexes_sql=()):
+    '''Replaces the contents of a table in a single transaction.
+
+    The rows are inserted with executemany into a shadow table, which is then
+    renamed over the live one before committing, so a reader sees either the
+    old table or the complete new one.
+
+    params
+    ------
+    table : str
+        the table to replace
+    create_sql : str
+        the table's CREATE statement, with a {table} placeholder
+    rows : list
+        the rows to insert, in column order (without the Id)
+    indexes_sql : list
+        CREATE INDEX statements to run on the new table once it is swapped in
+
+    returns
+    -------
+    int
+        the number of rows loaded
+    '''
+    shadow = f"{table}_loading"
+    start = time.perf_counter()
+
+    conn = connect_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(f'DROP TABLE IF EXISTS "{shadow}"')
+        conn.execute(create_sql.format(table=shadow))
+        if rows:
+            placeholders = ", ".join("?" * len(rows[0]))
+            conn.executemany(f'INSERT INTO "{shadow}" VALUES (NULL, {placeholders})', rows)
+        conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+        conn.execute(f'ALTER TABLE "{shadow}" RENAME TO "{table}"')
+        bump_data_version(conn)
+        for index_sql in indexes_sql:
+            conn.execute(index_sql)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - start
+    progress(f"Loaded {len(rows)} rows into {table} in {elapsed:.3f}s ({len(rows) / max(elapsed, 1e-9):,.0f} rows/sec)")
+    return len(rows)
+
+
+def cases_rows(covid_cases, countries):
+    '''Zips the cases columns into (country id, canonical name, new cases,
+    active cases, new deaths, total cases, total deaths, day) rows, with None
+    for masked counts.'''
+    resolved = [countries[name] for name in covid_cases['country']]
+    return list(zip(
+        [country_id for country_id, _ in resolved],
+        [name for _, name in resolved],
+        *[covid_cases[column].tolist() for column in CASES_COUNT_COLUMNS],
+        covid_cases['day'].tolist()
+    ))
+
+
+def row_hash(values):
+    '''Returns a 64 bit content hash of a row's values, stored alongside the
+    row so a refresh can tell which rows changed.'''
+    digest = hashlib.blake2b(repr(tuple(values)).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def with_row_hashes(rows):
+    '''Appends each row's content hash, keeping only the last row for each
+    country id (two source spellings can resolve to the same country).'''
+    latest = {row[0]: row for row in rows}
+    return [row + (row_hash(row),) for row in latest.values()]
+
+
+def cases_table_rows(covid_cases, countries):
+    '''Builds the Cases table rows, in CASES_COLUMNS order.'''
+    return with_row_hashes([row[:-1] for row in cases_rows(covid_cases, countries)])
+
+
+def population_table_rows(pop_dict, countries):
+    '''Builds the Population table rows, in POPULATION_COLUMNS order.'''
+    return with_row_hashes([
+        (*countries[k], *[v[field] for field in POPULATION_FIELDS])
+        for k, v in pop_dict.items()
+    ])
+
+
+@timed('load')
+def upsert_snapshot(table, columns, rows):
+    '''Brings a snapshot table in line with a new set of rows, writing only
+    what changed: the stored row hashes are compared with the new ones, rows
+    whose hash differs are updated, new countries are inserted and countries
+    missing from the new rows are deleted.
+
+    params
+    ------
+    table : str
+        the table to refresh
+    columns : list
+        the table's columns, without the Id, ending in RowHash
+    rows : list
+        the new rows, in column order, with a unique CountryId
+
+    returns
+    -------
+    list
+        the country ids of the rows inserted, updated or deleted
+    '''
+    quoted = ", ".join(f'"{c}"' for c in columns)
+    updates = ", ".join(f'"{c}" = excluded."{c}"' for c in columns[1:])
+    upsert_sql = f'''
+        INSERT INTO "{table}" ({quoted}) VALUES ({", ".join("?" * len(columns))})
+        ON CONFLICT (CountryId) DO UPDATE SET {updates}
+    '''
+    delete_sql = f'DELETE FROM "{table}" WHERE CountryId IN (SELECT value FROM json_each(?))'
+
+    conn = connect_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        stored = dict(conn.execute(f'SELECT CountryId, RowHash FROM "{table}"'))
+        changed = [row for row in rows if stored.get(row[0]) != row[-1]]
+        deleted = stored.keys() - {row[0] for row in rows}
+        conn.executemany(upsert_sql, changed)
+        conn.execute(delete_sql, (json.dumps(list(deleted)),))
+        if changed or deleted:
+            bump_data_version(conn)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return [row[0] for row in changed] + list(deleted)
+
+
+def load_cases(covid_cases=None):
+    '''Loads covid cases into a SQL database.
+
+    params
+    ------
+    covid_cases : dict
+        cases columns from create_covid_cases_columns; fetched if not given
+
+    returns
+    -------
+    int
+        the number of rows loaded
+    '''
+    if covid_cases is None:
+        covid_cases = create_covid_cases_columns(make_request(covid_url, allow_stale=False))
+
+    countries = resolve_countries(covid_cases['country'])
+    rows = cases_table_rows(covid_cases, countries)
+    loaded = bulk_load("Cases", CASES_TABLE_SQL, rows, CASES_INDEXES_SQL)
+    record_history(covid_cases, countries)
+    refresh_metrics()
+    return loaded
+
+
+def refresh_cases(covid_cases=None):
+    '''Updates the Cases table in place with only the countries whose
+    figures changed since the last load, and records them in the history.
+
+    params
+    ------
+    covid_cases : dict
+        cases columns from create_covid_cases_columns; fetched if not given
+
+    returns
+    -------
+    int
+        the number of Cases rows touched
+    '''
+    if covid_cases is None:
+        covid_cases = create_covid_cases_columns(make_request(covid_url, allow_stale=False, max_age=0))
+
+    countries = resolve_countries(covid_cases['country'])
+    changed = upsert_snapshot("Cases", CASES_COLUMNS, cases_table_rows(covid_cases, countries))
+    progress(f"Refreshed Cases: {len(changed)} rows touched")
+    record_history(covid_cases, countries)
+    if changed:
+        refresh_metrics(changed)
+    return len(changed)
+
+
+def parse_percentage(text):
+    '''Converts a Wikipedia percentage such as "+1.02%" or "−0.5%" to a
+    fraction, or None if it isn't a number.'''
+    try:
+        return float(text.replace('\u2212', '-').replace('%', '').strip()) / 100
+    except (AttributeError, ValueError):
+        return None
+
+
+def compute_metrics(country_id, country, population, total_cases, total_deaths, active_cases, change):
+    '''Derives one CountryMetrics row from a country's cases and population.
+
+    The growth-adjusted rate divides by the 2019 population projected to
+    today with the country's annual growth rate.'''
+    def ratio(numerator, denominator, scale=1):
+        if numerator is None or not denominator:
+            return None
+        return numerator / denominator * scale
+
+    growth = parse_percentage(change)
+    adjusted_population = population
+    if growth is not None:
+        years = (datetime.date.today() - POPULATION_ESTIMATE_DATE).days / 365.25
+        adjusted_population = population * (1 + growth) ** years
+
+    return (
+        country_id,
+        country,
+        population,
+        ratio(total_cases, population),
+        ratio(total_deaths, population, 1_000_000),
+        ratio(active_cases, total_cases),
+        growth,
+        ratio(total_cases, adjusted_population),
+    )
+
+
+@timed('load')
+def refresh_metrics(country_ids=None):
+    '''Recomputes the CountryMetrics rows for the given countries (all of
+    them by default) from the Cases and Population tables. Countries that
+    are no longer in both tables are removed.
+
+    params
+    ------
+    country_ids : list
+        ids of the countries whose cases or population changed
+
+    returns
+    -------
+    int
+        the number of metrics rows written
+    '''
+    ids = None if country_ids is None else json.dumps(list(country_ids))
+    conn = connect_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = [compute_metrics(*row) for row in conn.execute(METRICS_SOURCE_SQL, {'ids': ids})]
+        if ids is None:
+            conn.execute('DELETE FROM CountryMetrics')
+        else:
+            conn.execute('DELETE FROM CountryMetrics WHERE CountryId IN (SELECT value FROM json_each(?))', (ids,))
+        conn.executemany(f'INSERT INTO CountryMetrics VALUES ({", ".join("?" * 8)})', rows)
+        bump_data_version(conn)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return len(rows)
+
+
+@timed('load')
+def record_history(covid_cases, countries=None, downsample=True):
+    '''Upserts a snapshot of covid cases into the CasesHistory table, keyed by
+    country and day, then rolls old daily rows up into weeks.
+
+    Loading the same day again only rewrites the countries whose figures changed.
+
+    params
+    ------
+    covid_cases : dict
+        cases columns from create_covid_cases_columns
+    countries : dict
+        the names already resolved by resolve_countries, if available
+    downsample : bool
+        roll old daily rows up into weeks afterwards
+
+    returns
+    -------
+    int
+        the number of history rows written
+    '''
+    if countries is None:
+        countries = resolve_countries(covid_cases['country'])
+    rows = [
+        (country_id, day, new_cases, active_cases, new_deaths, total_cases)
+        for country_id, _, new_cases, active_cases, new_deaths, total_cases, _, day in cases_rows(covid_cases, countries)
+    ]
+
+    conn = connect_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        before = conn.total_changes
+        conn.executemany(UPSERT_HISTORY_SQL, rows)
+        written = conn.total_changes - before
+        if written:
+            bump_data_version(conn)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    progress(f"Recorded {written} changed rows into CasesHistory")
+    if downsample:
+        downsample_history()
+    return written
+
+
+@timed('load')
+def downsample_history(keep_days=HISTORY_DAILY_RETENTION_DAYS):
+    '''Rolls daily history older than keep_days into weekly rows.
+
+    The cutoff is moved back to a Monday so only whole weeks are rolled up.
+
+    params
+    ------
+    keep_days : int
+        how many recent days stay at daily resolution
+
+    returns
+    -------
+    int
+        the number of daily rows that were rolled up
+    '''
+    conn = connect_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        cutoff = conn.execute(
+            "SELECT date('now', ?, '-6 days', 'weekday 1')", (f'-{keep_days} days',)
+        ).fetchone()[0]
+        conn.execute(DOWNSAMPLE_HISTORY_SQL, {'cutoff': cutoff})
+        removed = conn.execute(
+            "DELETE FROM CasesHistory WHERE Granularity = 'day' AND Day < ?", (cutoff,)
+        ).rowcount
+        if removed:
+            bump_data_version(conn)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return removed
+
+
+def load_population(pop_dict=None):
+    '''Loads countries' population data into a SQL database.
+
+    params
+    ------
+    pop_dict : dict
+        population data from scrape_wiki_data; scraped if not given
+
+    returns
+    -------
+    int
+        the number of rows loaded
+    '''
+    if pop_dict is None:
+        pop_dict = scrape_wiki_data()
+
+    countries = resolve_countries(pop_dict.keys())
+    rows = population_table_rows(pop_dict, countries)
+    loaded = bulk_load("Population", POPULATION_TABLE_SQL, rows, POPULATION_INDEXES_SQL)
+    refresh_metrics()
+    return loaded
+
+
+def refresh_population_records(pop_dict):
+    '''Updates the Population table in place with only the countries whose
+    figures changed.
+
+    params
+    ------
+    pop_dict : dict
+        population records, as from parse_population_table
+
+    returns
+    -------
+    int
+        the number of Population rows touched
+    '''
+    countries = resolve_countries(pop_dict.keys())
+    changed = upsert_snapshot("Population", POPULATION_COLUMNS, population_table_rows(pop_dict, countries))
+    progress(f"Refreshed Population: {len(changed)} rows touched")
+    if changed:
+        refresh_metrics(changed)
+    return len(changed)
+
+
+##################### sources ##########################
+JHU_CONFIRMED_FILENAME = "time_series_covid19_confirmed_global.csv"
+JHU_DEATHS_FILENAME = "time_series_covid19_deaths_global.csv"
+
+
+class Source:
+    '''Base class for ingestion plugins.
+
+    A source fetches one raw payload, which ingest does in a worker thread
+    with retries, and parses it into records in the schema of its kind (see
+    RECORD_LOADERS). Subclasses set name, kind and usually default_location,
+    implement parse and are registered in SOURCES.
+
+    Attributes
+    ----------
+    name : str
+        the name the source is registered under
+    kind : str
+        the records it produces, 'cases' or 'population'
+    location : str
+        the url or path it reads
+    hash_key : str
+        the Meta key its payload's fingerprint is kept under, or None if it
+        can't tell an unchanged payload
+    latest : tuple
+        (fingerprint, latest_records of the last parse), which stands in for
+        the payload while its fingerprint stays the same
+    '''
+    name = None
+    kind = None
+    default_location = None
+    hash_key = None
+    latest = None
+
+    def __init__(self, location=None):
+        self.location = location or self.default_location
+        if self.location is None:
+            raise ValueError(f"The {self.name} source needs a location: {self.name}=PATH")
+
+    def __repr__(self):
+        return f"{self.name}={self.location}"
+
+    def fetch(self, location, max_age=None, timeout=None):
+        '''Returns the raw payload at location; max_age and timeout are
+        passed on to make_request_with_cache by sources read over http.'''
+        return location
+
+    def parse(self, raw):
+        '''Returns the payload's records, in the schema of the source's kind.'''
+        raise NotImplementedError
+
+    def fingerprint(self, raw):
+        '''Returns a hash that changes whenever the payload does, or None.'''
+        return None
+
+
+class RapidApiSource(Source):
+    '''Today's cases per country from the covid-193 API on RapidAPI.'''
+    name = 'rapidapi'
+    kind = 'cases'
+
+    @property
+    def default_location(self):
+        return covid_url
+
+    def fetch(self, location, max_age=None, timeout=None):
+        return make_request(location, allow_stale=False, max_age=max_age, timeout=timeout)
+
+    def parse(self, raw):
+        return create_covid_cases_columns(raw)
+
+
+class WikipediaSource(Source):
+    '''Population per country from the Wikipedia list of countries by
+    population (United Nations).'''
+    name = 'wikipedia'
+    kind = 'population'
+    hash_key = 'population_page_hash'
+
+    @property
+    def default_location(self):
+        return wikipedia_url
+
+    def fetch(self, location, max_age=None, timeout=None):
+        return make_request_with_cache(location, allow_stale=False, max_age=max_age, timeout=timeout)
+
+    def parse(self, raw):
+        return parse_population_table(raw)
+
+    def fingerprint(self, raw):
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def read_jhu_time_series(path):
+    '''Streams a JHU CSSE global time series CSV row by row, summing the
+    provinces of each country.
+
+    params
+    ------
+    path : str
+        a time_series_covid19_*_global.csv file
+
+    returns
+    -------
+    tuple
+        the days the file covers, as ISO dates, and a dict of each country's
+        cumulative counts as an int64 array over those days
+    '''
+    import numpy as np
+
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        if 'Country/Region' not in header:
+            raise ValueError(f"{path} is not a JHU CSSE time series")
+        country_column = header.index('Country/Region')
+        first_day = next((i for i, heading in enumerate(header) if re.fullmatch(r'\d+/\d+/\d+', heading)), len(header))
+        days = [datetime.datetime.strptime(heading, '%m/%d/%y').date().isoformat() for heading in header[first_day:]]
+
+        totals = {}
+        for row in reader:
+            if not row:
+                continue
+            try:
+                counts = np.array(row[first_day:], dtype=np.int64)
+            except ValueError:
+                # blank or decimal cells in edited dumps
+                counts = np.array([int(float(cell or 0)) for cell in row[first_day:]], dtype=np.int64)
+            country = row[country_column]
+            if country in totals:
+                totals[country] += counts
+            else:
+                totals[country] = counts
+    return days, totals
+
+
+class JhuTimeSeriesSource(Source):
+    '''Daily cases and deaths per country from a local copy of the JHU CSSE
+    global time series (csse_covid_19_data/csse_covid_19_time_series).
+
+    The location is the folder holding the confirmed and deaths CSVs, or the
+    confirmed CSV itself. New cases and deaths are the day to day changes in
+    the cumulative counts; the dump has no active cases, so they stay masked.
+    '''
+    name = 'jhu'
+    kind = 'cases'
+    hash_key = 'jhu_files_hash'
+
+    def fetch(self, location, max_age=None, timeout=None):
+        if os.path.isdir(location):
+            confirmed = os.path.join(location, JHU_CONFIRMED_FILENAME)
+            deaths = os.path.join(location, JHU_DEATHS_FILENAME)
+        else:
+            confirmed = location
+            deaths = os.path.join(os.path.dirname(location), os.path.basename(location).replace('confirmed', 'deaths'))
+        if not os.path.isfile(confirmed):
+            raise FileNotFoundError(f"No JHU time series at {confirmed}")
+        return confirmed, (deaths if deaths != confirmed and os.path.isfile(deaths) else None)
+
+    def fingerprint(self, raw):
+        files = [(path, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in raw if path]
+        return hashlib.sha1(repr(files).encode('utf-8')).hexdigest()
+
+    @timed('parse_cases')
+    def parse(self, raw):
+        import numpy as np
+
+        confirmed_path, deaths_path = raw
+        days, confirmed = read_jhu_time_series(confirmed_path)
+        deaths = {}
+        if deaths_path:
+            death_days, deaths = read_jhu_time_series(deaths_path)
+            if death_days != days:
+                raise ValueError(f"{deaths_path} covers different days than {confirmed_path}")
+        if not confirmed or not days:
+            raise ValueError(f"{confirmed_path} has no counts")
+
+        names = list(confirmed)
+        unknown = np.full(len(days), NULL_COUNT, dtype=np.int64)
+        total_cases = np.stack([confirmed[name] for name in names])
+        total_deaths = np.stack([deaths.get(name, unknown) for name in names])
+        new_cases = np.diff(total_cases, axis=1, prepend=0)
+        new_deaths = np.where(total_deaths == NULL_COUNT, NULL_COUNT, np.diff(total_deaths, axis=1, prepend=0))
+        active_cases = np.full(total_cases.shape, NULL_COUNT, dtype=np.int64)
+
+        # one row per country and day, each country's days in order
+        columns = {
+            'country': np.repeat(np.array(names, dtype=object), len(days)),
+            'day': np.tile(np.array(days, dtype=object), len(names)),
+        }
+        for column, values in zip(CASES_COUNT_COLUMNS, (new_cases, active_cases, new_deaths, total_cases, total_deaths)):
+            columns[column] = np.ma.masked_equal(values.ravel(), NULL_COUNT, copy=False)
+        return columns
+
+
+# source plugins by name, as given to --source
+SOURCES = {source.name: source for source in (RapidApiSource, WikipediaSource, JhuTimeSeriesSource)}
+DEFAULT_SOURCES = ['rapidapi', 'wikipedia']
+
+
+def make_source(spec):
+    '''Builds a source from a "name" or "name=location" spec.
+
+    params
+    ------
+    spec : str or Source
+        e.g. "wikipedia" or "jhu=COVID-19/csse_covid_19_data/csse_covid_19_time_series";
+        a Source is returned as is
+
+    returns
+    -------
+    Source
+        the configured source
+
+    raises
+    ------
+    ValueError
+        if no source has that name, or it needs a location and got none
+    '''
+    if isinstance(spec, Source):
+        return spec
+    name, _, location = spec.partition('=')
+    if name not in SOURCES:
+        raise ValueError(f"Unknown source {name!r}: choose from {', '.join(SOURCES)}")
+    return SOURCES[name](location or None)
+
+
+# the loaders (full reload, refresh) for each kind of record. Every source of
+# a kind produces records in the same schema, so the tables and graphs never
+# see where the data came from:
+#   'cases'      columns as made by create_covid_cases_columns: 'country' and
+#                'day' object arrays plus an int64 masked array for each of
+#                CASES_COUNT_COLUMNS, one entry per country and day
+#   'population' {country: {field: value}} with the POPULATION_FIELDS, as made
+#                by parse_population_table
+RECORD_LOADERS = {
+    'cases': (load_cases, refresh_cases),
+    'population': (load_population, refresh_population_records),
+}
+
+
+def merge_records(kind, batches):
+    '''Combines the records several sources produced for one kind.
+
+    Cases columns are joined and put in day order, so where sources overlap
+    each country's Cases row comes from its latest day. Population records
+    from later sources replace earlier ones.
+
+    params
+    ------
+    kind : str
+        a key of RECORD_LOADERS
+    batches : list
+        each source's records
+
+    returns
+    -------
+    the merged records, in the same schema
+    '''
+    if len(batches) == 1:
+        return batches[0]
+    if kind == 'population':
+        merged = {}
+        for batch in batches:
+            merged.update(batch)
+        return merged
+
+    import numpy as np
+
+    order = np.argsort(np.concatenate([batch['day'] for batch in batches]), kind='stable')
+    return {
+        column: (np.concatenate if column in ('country', 'day') else np.ma.concatenate)(
+            [batch[column] for batch in batches])[order]
+        for column in batches[0]
+    }
+
+
+def latest_records(kind, records):
+    '''Keeps the records a source contributes to the snapshot tables: for
+    cases, each country's row from its latest day. That is all
+    merge_records needs from a source whose history is already recorded.
+
+    params
+    ------
+    kind : str
+        a key of RECORD_LOADERS
+    records : dict
+        one source's records
+
+    returns
+    -------
+    the kept records, in the same schema
+    '''
+    if kind == 'population':
+        return records
+
+    import numpy as np
+
+    # the last occurrence of each country once the rows are in day order
+    order = np.argsort(records['day'], kind='stable')[::-1]
+    _, first = np.unique(records['country'][order], return_index=True)
+    keep = np.sort(order[first])
+    return {column: values[keep] for column, values in records.items()}
+
+
+def record_count(kind, records):
+    '''Returns how many records a source produced.'''
+    return len(records['country']) if kind == 'cases' else len(records)
+
+
+##################### ingestion ##########################
+def is_retryable(error):
+    '''Decides whether a failed fetch is worth retrying: timeouts, connection
+    problems, rate limiting and server errors are, other HTTP errors are not.'''
+    import requests
+
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, requests.RequestException)
+
+
+async def fetch_with_retry(semaphore, fetch, *args, retries=None, timeout=None, backoff=None):
+    '''Runs a blocking fetch in a worker thread, bounded by a semaphore, with
+    a timeout and exponential backoff (with jitter) between retries.
+
+    The timeout is handed to the fetch, which passes it to requests, so a
+    stalled server ends the thread itself. The semaphore is held until that
+    thread returns, so at most `concurrency` fetches ever run at once.
+
+    params
+    ------
+    semaphore : asyncio.Semaphore
+        limits how many fetches run at once
+    fetch : function
+        the blocking fetch, e.g. make_request; called with timeout=
+    *args
+        arguments for the fetch
+    retries : int
+        how many times to retry after the first attempt (INGEST_RETRIES)
+    timeout : float
+        the request timeout for each attempt (INGEST_TIMEOUT)
+    backoff : float
+        delay before the first retry, doubled for every retry after it (INGEST_BACKOFF)
+
+    returns
+    -------
+    the fetch's return value
+    '''
+    import asyncio
+
+    retries = INGEST_RETRIES if retries is None else retries
+    timeout = INGEST_TIMEOUT if timeout is None else timeout
+    backoff = INGEST_BACKOFF if backoff is None else backoff
+
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                return await asyncio.to_thread(fetch, *args, timeout=timeout)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            progress(f"[Error] Fetching {args[0]} failed ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def ingest_kind(semaphore, kind, sources, full_reload=False, max_age=None):
+    '''Fetches every source of one kind concurrently, parses their payloads
+    in worker threads and loads the merged records in one go.
+
+    Unless full_reload is set, a source whose fingerprint matches the one
+    stored in Meta isn't parsed again once this Source object has parsed it:
+    the latest records it kept stand in for it, so only the sources that
+    changed are parsed and have their history recorded. When no source
+    changed, nothing is written at all.
+
+    returns
+    -------
+    int
+        the number of rows loaded or touched
+    '''
+    import asyncio
+
+    payloads = await asyncio.gather(*(
+        fetch_with_retry(semaphore, source.fetch, source.location, max_age) for source in sources
+    ))
+    hashes = [source.fingerprint(raw) for source, raw in zip(sources, payloads)]
+    unchanged = [
+        not full_reload and payload_hash is not None and payload_hash == get_meta(source.hash_key)
+        for source, payload_hash in zip(sources, hashes)
+    ]
+    if all(unchanged):
+        progress(f"Refreshed {kind}: {', '.join(source.name for source in sources)} unchanged, 0 rows touched")
+        return 0
+
+    async def records(source, raw, payload_hash, same):
+        if same and source.latest is not None and source.latest[0] == payload_hash:
+            progress(f"Reusing the last parse of {source.name}, which is unchanged")
+            return source.latest[1]
+        batch = await asyncio.to_thread(source.parse, raw)
+        count('covid_source_records_total', record_count(kind, batch), source=source.name)
+        if payload_hash is not None:
+            source.latest = (payload_hash, latest_records(kind, batch))
+        # an unchanged source's history is already recorded
+        return source.latest[1] if same else batch
+
+    batches = await asyncio.gather(*(
+        records(source, raw, payload_hash, same)
+        for source, raw, payload_hash, same in zip(sources, payloads, hashes, unchanged)
+    ))
+    load, refresh = RECORD_LOADERS[kind]
+    loaded = await asyncio.to_thread(load if full_reload else refresh, merge_records(kind, batches))
+    for source, payload_hash in zip(sources, hashes):
+        if payload_hash is not None:
+            set_meta(source.hash_key, payload_hash)
+    return loaded
+
+
+async def ingest_async(sources, concurrency=None, full_reload=False, max_age=None):
+    '''Runs the pipelines for each kind of record concurrently.
+
+    params
+    ------
+    sources : list
+        the Source plugins to read
+    concurrency : int
+        how many fetches may be in flight at once (INGEST_CONCURRENCY)
+    full_reload : bool
+        rebuild the tables instead of refreshing the changed rows
+    max_age : float
+        seconds a cached response may be used without asking the server
+        (the url's TTL by default)
+
+    returns
+    -------
+    dict
+        the rows loaded or touched for each kind of record
+    '''
+    import asyncio
+
+    semaphore = asyncio.Semaphore(concurrency or INGEST_CONCURRENCY)
+    kinds = {}
+    for source in sources:
+        kinds.setdefault(source.kind, []).append(source)
+    loaded = await asyncio.gather(*(
+        ingest_kind(semaphore, kind, kind_sources, full_reload, max_age) for kind, kind_sources in kinds.items()
+    ))
+    return dict(zip(kinds, loaded))
+
+
+def ingest(sources=None, concurrency=None, full_reload=False, max_age=None):
+    '''Fetches every source exactly once, concurrently, and brings the SQL
+    database up to date, so a cold start takes about as long as the slowest
+    fetch. By default only changed rows are written; full_reload rebuilds
+    the tables from scratch.
+
+    params
+    ------
+    sources : list
+        Source plugins or "name=location" specs for make_source,
+        DEFAULT_SOURCES by default
+    concurrency : int
+        how many fetches may be in flight at once (INGEST_CONCURRENCY)
+    full_reload : bool
+        rebuild the tables instead of refreshing the changed rows
+    max_age : float
+        seconds a cached response may be used without asking the server;
+        0 sends a conditional request to every source. Cached copies past
+        it are never loaded stale, since this may be a one-shot run.
+
+    returns
+    -------
+    dict
+        the rows loaded or touched for each kind of record
+    '''
+    import asyncio
+
+    sources = [make_source(spec) for spec in sources or DEFAULT_SOURCES]
+    create_db()
+    start = time.perf_counter()
+    results = asyncio.run(ingest_async(sources, concurrency, full_reload, max_age))
+    progress(f"Ingested all sources in {time.perf_counter() - start:.2f}s ({sum(results.values())} rows written)")
+    return results
+
+
+class Refresher(threading.Thread):
+    '''Keeps the SQL database current by refreshing each kind of record from
+    its sources on its own interval, with random jitter so several
+    refreshers don't poll in step.
+
+    Each poll runs the same pipeline as ingest over that kind's sources. The
+    refresher keeps its Source objects between polls, so a source whose
+    fingerprint hasn't changed is parsed on the first poll only; after that
+    its last parse stands in for it and only the changed sources are parsed.
+    Refreshes only write the rows that changed, in short WAL transactions, so
+    the menu and graphs keep reading from the database while they run. Every
+    poll asks the server (a conditional request, so unchanged data costs a
+    304) rather than trusting the cache's TTL, and its progress goes to
+    stderr, away from the menu's prompts.
+
+    Attributes
+    ----------
+    sources : dict
+        the Source plugins to poll, per kind ('cases', 'population')
+    intervals : dict
+        seconds between refreshes, per kind
+    jitter : float
+        each wait is stretched or shrunk by up to this fraction
+    stopped : threading.Event
+        set to make the refresher exit after its current refresh
+    '''
+    def __init__(self, intervals=None, jitter=None, run_now=False, sources=None):
+        super().__init__(name="refresher", daemon=True)
+        self.sources = {}
+        for source in sources or DEFAULT_SOURCES:
+            source = make_source(source)
+            self.sources.setdefault(source.kind, []).append(source)
+        self.intervals = dict(REFRESH_INTERVALS, **(intervals or {}))
+        self.jitter = REFRESH_JITTER if jitter is None else jitter
+        self.stopped = threading.Event()
+        now = time.monotonic()
+        self.next_run = {
+            kind: now if run_now else now + self._wait(kind)
+            for kind in self.sources
+        }
+
+    def _wait(self, kind):
+        return self.intervals[kind] * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def run(self):
+        import asyncio
+
+        PROGRESS_OUTPUT.set(sys.stderr)
+        while not self.stopped.is_set():
+            for kind, due in self.next_run.items():
+                if time.monotonic() >= due:
+                    try:
+                        asyncio.run(ingest_async(self.sources[kind], max_age=0))
+                    except Exception as e:
+                        progress(f"[Error] Refreshing {kind} failed: {e}")
+                    self.next_run[kind] = time.monotonic() + self._wait(kind)
+            self.stopped.wait(max(0, min(self.next_run.values()) - time.monotonic()))
+
+    def stop(self):
+        self.stopped.set()
+
+
+class RateLimiter:
+    '''Spaces out requests to one host so that, across all threads, no more
+    than `rate` requests start per second.
+
+    Attributes
+    ----------
+    interval : float
+        seconds between request starts
+    '''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.RLock()
+        self.next_start = time.monotonic()
+
+    def wait(self):
+        '''Blocks until the caller may start its request.'''
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_start, now)
+            self.next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def get_rate_limiter(url, rate):
+    '''Returns the shared RateLimiter for a url's host, creating it if needed.'''
+    host = urllib.parse.urlsplit(url).netloc
+    with CACHE_LOCK:
+        limiter = RATE_LIMITERS.get(host)
+        if limiter is None or limiter.interval != 1.0 / rate:
+            limiter = RATE_LIMITERS[host] = RateLimiter(rate)
+    return limiter
+
+
+def fetch_country_history(country, rate=None):
+    '''Fetches a country's full history from the covid API, waiting on the
+    host's rate limiter and retrying failures with exponential backoff.
+
+    History responses are large and only read once, so they bypass the cache.
+
+    params
+    ------
+    country : str
+        the country's name as the API spells it
+    rate : float
+        requests per second allowed to the API host (BACKFILL_REQUESTS_PER_SECOND)
+
+    returns
+    -------
+    dict
+        the decoded json response
+    '''
+    import requests
+
+    limiter = get_rate_limiter(history_url, rate or BACKFILL_REQUESTS_PER_SECOND)
+    headers = {
+        'x-rapidapi-host' : "covid-193.p.rapidapi.com",
+        'x-rapidapi-key' : get_api_key()
+    }
+    for attempt in range(INGEST_RETRIES + 1):
+        limiter.wait()
+        try:
+            response = http_get(history_url, headers=headers, params={'country': country})
+            response.raise_for_status()
+            return response.json()
+        except requests.RequestException as e:
+            if attempt == INGEST_RETRIES or not is_retryable(e):
+                raise
+            time.sleep(INGEST_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def latest_snapshot_per_day(history_json):
+    '''Keeps only the last of the API's many snapshots for each day.
+
+    params
+    ------
+    history_json : dict
+        a response from the history endpoint
+
+    returns
+    -------
+    dict
+        a response-shaped dict with one entry per day, oldest first
+    '''
+    latest = {}
+    for snapshot in history_json['response']:
+        day = snapshot['day']
+        if day not in latest or snapshot['time'] > latest[day]['time']:
+            latest[day] = snapshot
+    return {'response': [latest[day] for day in sorted(latest)]}
+
+
+def set_checkpoint(country, status, rows=None, error=None):
+    '''Records how far the backfill of one country got.'''
+    conn = get_connection()
+    conn.execute(UPSERT_CHECKPOINT_SQL, (country, status, rows, error))
+
+
+def backfill_country(country, rate=None):
+    '''Backfills one country's history and checkpoints the result.
+
+    returns
+    -------
+    int
+        the number of history rows written
+    '''
+    set_checkpoint(country, 'running')
+    try:
+        history = latest_snapshot_per_day(fetch_country_history(country, rate))
+        written = 0
+        if history['response']:
+            written = record_history(create_covid_cases_columns(history), downsample=False)
+    except Exception as e:
+        set_checkpoint(country, 'failed', error=repr(e))
+        raise
+    set_checkpoint(country, 'done', rows=written)
+    return written
+
+
+def backfill_history(workers=None, rate=None, countries=None, restart=False):
+    '''Backfills per-country history from the covid API's history endpoint
+    using a pool of worker threads.
+
+    Progress is checkpointed per country in the BackfillCheckpoints table,
+    so an interrupted run picks up where it stopped: countries already
+    marked done are skipped unless restart is set.
+
+    params
+    ------
+    workers : int
+        number of worker threads (BACKFILL_WORKERS)
+    rate : float
+        requests per second allowed to the API host, shared by all workers
+        (BACKFILL_REQUESTS_PER_SECOND)
+    countries : list
+        API country names to backfill; every country the API knows by default
+    restart : bool
+        forget earlier checkpoints and backfill everything again
+
+    returns
+    -------
+    dict
+        counts of countries 'done', 'failed' and 'skipped'
+    '''
+    import concurrent.futures
+
+    create_db()
+    if countries is None:
+        countries = make_request(countries_url, allow_stale=False)['response']
+    if restart:
+        get_connection().execute('DELETE FROM BackfillCheckpoints')
+    done = {row[0] for row in get_connection().execute(
+        "SELECT Country FROM BackfillCheckpoints WHERE Status = 'done'")}
+    pending = [c for c in countries if c not in done]
+    summary = {'done': 0, 'failed': 0, 'skipped': len(countries) - len(pending)}
+
+    print(f"Backfilling history for {len(pending)} countries ({summary['skipped']} already done)")
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or BACKFILL_WORKERS) as pool:
+        futures = {pool.submit(backfill_country, c, rate): c for c in pending}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+                summary['done'] += 1
+            except Exception as e:
+                summary['failed'] += 1
+                print(f"[Error] Backfill of {futures[future]} failed: {e}")
+
+    downsample_history()
+    elapsed = time.perf_counter() - start
+    print(f"Backfilled {summary['done']} countries in {elapsed:.1f}s, {summary['failed']} failed")
+    return summary
+
+
+##################### accessing DBs via user entry ##########################
+ALL_CASES_SQL = '''
+    SELECT Country, TotalCases
+    FROM Cases
+    ORDER BY TotalCases DESC
+'''
+
+# countries only (no continents or worldwide totals), largest first
+COUNTRY_TOTALS_SQL = '''
+    SELECT c.Country, c.TotalCases
+    FROM Cases c
+    JOIN Countries k ON k.Id = c.CountryId
+    WHERE c.TotalCases IS NOT NULL AND k.Kind IS NOT 'aggregate'
+    ORDER BY c.TotalCases DESC
+'''
+
+REGION_TOTALS_SQL = '''
+    SELECT COALESCE(p.UNContinentalRegion, 'Unknown'), SUM(c.TotalCases)
+    FROM Cases c
+    JOIN Countries k ON k.Id = c.CountryId
+    LEFT JOIN Population p ON p.CountryId = c.CountryId
+    WHERE c.TotalCases IS NOT NULL AND k.Kind IS NOT 'aggregate'
+    GROUP BY 1
+    ORDER BY 2 DESC
+'''
+
+TOTALS_SQL = {
+    "all": '''
+        SELECT Country, TotalCases
+        FROM Cases
+        WHERE TotalCases IS NOT NULL
+        ORDER BY TotalCases DESC
+    ''',
+    "country": COUNTRY_TOTALS_SQL,
+    "region": REGION_TOTALS_SQL,
+}
+
+COUNTRY_CASES_SQL = '''
+    SELECT c.NewCases, c.ActiveCases, c.NewDeaths, c.TotalCases
+    FROM CountryAliases a
+    JOIN Cases c ON c.CountryId = a.CountryId
+    WHERE a.Key = ?
+'''
+
+COUNTRY_METRICS_SQL = '''
+    SELECT m.Country, m.Population, m.CasesPerCapita, m.DeathsPerMillion, m.ActiveRatio,
+        m.AnnualPopulationGrowth, m.AdjustedCasesPerCapita
+    FROM CountryAliases a
+    JOIN CountryMetrics m ON m.CountryId = a.CountryId
+    WHERE a.Key = ?
+'''
+
+COUNTRY_HISTORY_SQL = '''
+    SELECT h.Day, h.Granularity, h.NewCases, h.ActiveCases, h.NewDeaths, h.TotalCases
+    FROM CountryAliases a
+    JOIN CasesHistory h ON h.CountryId = a.CountryId
+    WHERE a.Key = ? AND h.Day >= date('now', ?)
+    ORDER BY h.Day
+'''
+
+COUNTRY_STATS_SQL = '''
+    SELECT p."2019population", c.NewCases, c.ActiveCases, c.NewDeaths, c.TotalCases
+    FROM CountryAliases a
+    JOIN Cases c ON c.CountryId = a.CountryId
+    JOIN Population p ON p.CountryId = a.CountryId
+    WHERE a.Key = ?
+'''
+
+DB_LOCAL = threading.local()
+
+
+def get_connection():
+    '''Returns this thread's persistent connection to the SQL database,
+    opening it on first use.
+
+    Keeping the connection open lets sqlite reuse the prepared statements
+    for the parameterised queries below instead of reparsing them.
+
+    Params
+    ------
+    None
+
+    Returns
+    -------
+    sqlite3.Connection
+        the thread's connection
+    '''
+    conn = getattr(DB_LOCAL, 'conn', None)
+    if conn is None:
+        conn = connect_db()
+        DB_LOCAL.conn = conn
+    return conn
+
+
+def close_connection():
+    '''Closes this thread's persistent connection, if it has one.'''
+    conn = getattr(DB_LOCAL, 'conn', None)
+    if conn is not None:
+        conn.close()
+        DB_LOCAL.conn = None
+        DB_LOCAL.pragma_version = None
+
+
+def data_version():
+    '''Returns the version of the data, which the loaders bump in the Meta
+    table whenever they write.
+
+    sqlite's PRAGMA data_version changes whenever another connection
+    commits, so the Meta table is only read again after a write.
+
+    Returns
+    -------
+    int
+        the current data version
+    '''
+    pragma_version = get_connection().execute('PRAGMA data_version').fetchone()[0]
+    if getattr(DB_LOCAL, 'pragma_version', None) != pragma_version:
+        DB_LOCAL.data_version = int(get_meta('data_version', 0))
+        DB_LOCAL.pragma_version = pragma_version
+    return DB_LOCAL.data_version
+
+
+@timed('query')
+def access_cases_table(country):
+    '''Selects a country's COVID-19 data from the SQL database to display based on user entry.
+
+    Params
+    ------
+    country : str
+        A country to search for in the database.
+
+    Returns
+    -------
+    list
+        A country's corresponding COVID-19 data.
+    '''
+    conn = get_connection()
+    if country.lower() == "all":
+        return conn.execute(ALL_CASES_SQL).fetchall()
+    return conn.execute(COUNTRY_CASES_SQL, (normalize_country_key(country),)).fetchall()
+
+
+@timed('query')
+def access_totals(by="all"):
+    '''Reads total cases straight from the cursor into a typed array,
+    without building a Python list per row.
+
+    Params
+    ------
+    by : str
+        "all" for every row of the Cases table, "country" for countries
+        only, or "region" for sums per UN continental region.
+
+    Returns
+    -------
+    numpy.ndarray
+        records with a 'label' and an int64 'total' field, largest first.
+    '''
+    import numpy as np
+
+    dtype = np.dtype([('label', object), ('total', np.int64)])
+    return np.fromiter(get_connection().execute(TOTALS_SQL[by]), dtype=dtype)
+
+
+@timed('query')
+def access_country_stats(country):
+    '''Selects a country's 2019 population and COVID-19 data with a single query.
+
+    Params
+    ------
+    country : str
+        A country to search for in the database.
+
+    Returns
+    -------
+    tuple
+        (2019 population, new cases, active cases, new deaths, total cases),
+        or None if the country is missing from either table.
+    '''
+    return get_connection().execute(COUNTRY_STATS_SQL, (normalize_country_key(country),)).fetchone()
+
+
+@timed('query')
+def access_cases_history(country, days=30):
+    '''Selects a country's recorded COVID-19 history for the last few days.
+
+    Params
+    ------
+    country : str
+        A country to search for in the database.
+    days : int
+        How many days back to go.
+
+    Returns
+    -------
+    list
+        (day, granularity, new cases, active cases, new deaths, total cases)
+        rows, oldest first.
+    '''
+    return get_connection().execute(
+        COUNTRY_HISTORY_SQL, (normalize_country_key(country), f'-{days} days')
+    ).fetchall()
+
+
+@timed('query')
+def access_country_metrics(country):
+    '''Selects a country's precomputed per-capita metrics.
+
+    Params
+    ------
+    country : str
+        A country to search for in the database.
+
+    Returns
+    -------
+    tuple
+        (country, 2019 population, cases per capita, deaths per million,
+        active ratio, annual population growth, growth-adjusted cases per
+        capita), or None if the country is missing from either table.
+    '''
+    return get_connection().execute(COUNTRY_METRICS_SQL, (normalize_country_key(country),)).fetchone()
+
+
+@timed('query')
+def access_top_countries(metric, n=20):
+    '''Ranks countries by one of the precomputed metrics, using its index.
+
+    Params
+    ------
+    metric : str
+        One of the keys of METRIC_COLUMNS, e.g. "cases_per_capita".
+    n : int
+        How many countries to return.
+
+    Returns
+    -------
+    list
+        (country, metric value) rows, highest first.
+    '''
+    column = METRIC_COLUMNS[metric]
+    return get_connection().execute(f'''
+        SELECT Country, "{column}"
+        FROM CountryMetrics
+        WHERE "{column}" IS NOT NULL
+        ORDER BY "{column}" DESC
+        LIMIT ?
+    ''', (n,)).fetchall()
+
+
+ALL_ALIASES_SQL = '''
+    SELECT a.Key, c.Id, c.Name
+    FROM CountryAliases a
+    JOIN Countries c ON c.Id = a.CountryId
+'''
+
+
+class CountrySearchIndex:
+    '''In-memory index over every known spelling of every country.
+
+    Exact lookups are a dict hit on the normalized key, fuzzy matches are
+    ranked by how many three letter pieces (trigrams) they share with the
+    query, and autocomplete is a binary search over a sorted list of the
+    aliases and of every word-aligned tail of them, so "kor" completes to
+    South Korea.
+    '''
+
+    def __init__(self, rows, version=None):
+        '''
+        params
+        ------
+        rows : iterable
+            (alias key, country id, canonical name) rows
+        version : int
+            the data version the rows were read at
+        '''
+        self.version = version
+        self.aliases = []
+        self.exact = {}
+        self.postings = defaultdict(list)
+        self.prefixes = []
+        for key, country_id, name in rows:
+            position = len(self.aliases)
+            grams = self.trigrams(key)
+            self.aliases.append((key, country_id, name, len(grams)))
+            self.exact[key] = (country_id, name)
+            for gram in grams:
+                self.postings[gram].append(position)
+            words = key.split(' ')
+            for i in range(len(words)):
+                self.prefixes.append((" ".join(words[i:]), i, position))
+        self.prefixes.sort()
+
+    @staticmethod
+    def trigrams(key):
+        '''Splits a normalized key into its set of trigrams, padded so that
+        word starts count for more.'''
+        padded = f"  {key} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def lookup(self, text):
+        '''Returns (country id, canonical name) for an exact match on any
+        known spelling, or None.'''
+        return self.exact.get(normalize_country_key(text))
+
+    def search(self, text, n=5, min_score=None):
+        '''Ranks countries by how closely any of their spellings matches text.
+
+        params
+        ------
+        text : str
+            what the user typed
+        n : int
+            most matches to return
+        min_score : float
+            smallest similarity (0 to 1) worth returning (SEARCH_MIN_SCORE)
+
+        returns
+        -------
+        list
+            (canonical name, score) tuples, best first, one per country
+        '''
+        if min_score is None:
+            min_score = SEARCH_MIN_SCORE
+        grams = self.trigrams(normalize_country_key(text))
+        shared = defaultdict(int)
+        for gram in grams:
+            for position in self.postings.get(gram, ()):
+                shared[position] += 1
+
+        best = {}
+        for position, count in shared.items():
+            _, country_id, name, size = self.aliases[position]
+            score = 2 * count / (len(grams) + size)
+            if score >= min_score and score > best.get(country_id, (0, None))[0]:
+                best[country_id] = (score, name)
+        ranked = sorted(best.values(), key=lambda match: (-match[0], match[1]))
+        return [(name, round(score, 3)) for score, name in ranked[:n]]
+
+    def complete(self, prefix, n=10):
+        '''Lists countries with a spelling, or a word in one, starting with
+        prefix. Matches on a spelling's first word come first.
+
+        returns
+        -------
+        list
+            canonical names
+        '''
+        key = normalize_country_key(prefix)
+        start = bisect.bisect_left(self.prefixes, (key,))
+        matches = []
+        for tail, word, position in itertools.islice(self.prefixes, start, None):
+            if not tail.startswith(key):
+                break
+            matches.append((word, self.aliases[position][2]))
+
+        names = []
+        for _, name in sorted(matches):
+            if name not in names:
+                names.append(name)
+                if len(names) == n:
+                    break
+        return names
+
+
+SEARCH_INDEX = None
+SEARCH_INDEX_LOCK = threading.Lock()
+
+
+def get_search_index():
+    '''Returns the country search index, building it from the database on
+    first use and again only after the data has changed.'''
+    global SEARCH_INDEX
+    version = data_version()
+    index = SEARCH_INDEX
+    if index is None or index.version != version:
+        with SEARCH_INDEX_LOCK:
+            if SEARCH_INDEX is None or SEARCH_INDEX.version != version:
+                SEARCH_INDEX = CountrySearchIndex(get_connection().execute(ALL_ALIASES_SQL), version)
+            index = SEARCH_INDEX
+    return index
+
+
+def find_country(country):
+    '''Looks a country up by any of its known spellings, ignoring case,
+    accents and punctuation.
+
+    Params
+    ------
+    country : str
+        A country to search for in the database.
+
+    Returns
+    -------
+    tuple
+        (country id, canonical name), or None if it isn't on file.
+    '''
+    return get_search_index().lookup(country)
+
+
+def search_countries(text, n=5):
+    '''Ranks the countries whose names are closest to text, e.g. "Kora"
+    gives South Korea and North Korea.
+
+    Returns
+    -------
+    list
+        (canonical name, score between 0 and 1) tuples, best first.
+    '''
+    return get_search_index().search(text, n)
+
+
+def complete_countries(prefix, n=10):
+    '''Lists the countries that a partly typed name could complete to.
+
+    Returns
+    -------
+    list
+        canonical names.
+    '''
+    return get_search_index().complete(prefix, n)
+
+
+def did_you_mean(text):
+    '''Suggests known countries for a name that isn't on file, as text to
+    append to an error message.'''
+    suggestions = [name for name, _ in search_countries(text, 3)]
+    if not suggestions:
+        return ""
+    return f" Did you mean {', '.join(suggestions)}?"
+
+
+##################### data vis ############################
+FIGURE_FONT = dict(
+    family="Roboto Slab, monospace",
+    size=10,
+    color="#000"
+    )
+
+
+def all_cases_figure(totals, page=None, page_size=None):
+    '''Builds the chart of total cases across all countries. Pure: takes
+    the data and returns a plotly figure as a plain dict, so it can be shown,
+    cached or written out as JSON.
+
+    The points are drawn with a WebGL trace, which stays responsive with
+    thousands of them where one SVG bar per country does not.
+
+    params
+    ------
+    totals : numpy.ndarray
+        (label, total) records, as from access_totals("all")
+    page : int
+        draw only this page (from 0) of page_size records
+    page_size : int
+        records per page (ALL_CHART_PAGE_SIZE by default)
+
+    returns
+    -------
+    dict
+        the figure's data and layout
+    '''
+    title = "Combined new, active, and former COVID-19 cases across the globe"
+    if page is not None:
+        page_size = page_size or ALL_CHART_PAGE_SIZE
+        pages = max(1, -(-len(totals) // page_size))
+        totals = totals[page * page_size:(page + 1) * page_size]
+        title += f" (page {page + 1} of {pages})"
+
+    return {
+        'data': [{
+            'type': 'scattergl',
+            'mode': 'markers',
+            'x': totals['label'].tolist(),
+            'y': totals['total'].tolist(),
+        }],
+        'layout': {
+            'title': {'text': title},
+            'xaxis': {'title': {'text': "Country"}, 'type': 'category'},
+            'yaxis': {'title': {'text': "No. People Directly Affected by COVID-19"}},
+            'font': FIGURE_FONT,
+        },
+    }
+
+
+def totals_bar_figure(labels, values, title, xaxis_title):
+    '''Builds a bar graph of a few aggregated totals.'''
+    return {
+        'data': [{'type': 'bar', 'x': labels, 'y': values}],
+        'layout': {
+            'title': {'text': title},
+            'xaxis': {'title': {'text': xaxis_title}},
+            'yaxis': {'title': {'text': "No. People Directly Affected by COVID-19"}},
+            'font': FIGURE_FONT,
+        },
+    }
+
+
+def top_countries_figure(totals, top_n=None):
+    '''Builds a bar graph of the top_n countries by total cases, with the
+    rest summed into a single "Others" bar.
+
+    params
+    ------
+    totals : numpy.ndarray
+        (label, total) records, largest first, as from access_totals("country")
+    top_n : int
+        countries drawn on their own (ALL_CHART_TOP_N by default)
+
+    returns
+    -------
+    dict
+        the figure's data and layout
+    '''
+    top_n = top_n or ALL_CHART_TOP_N
+    labels = totals['label'][:top_n].tolist()
+    values = totals['total'][:top_n].tolist()
+    if len(totals) > top_n:
+        labels.append("Others")
+        values.append(int(totals['total'][top_n:].sum()))
+    return totals_bar_figure(labels, values, f"COVID-19 cases in the {top_n} most affected countries and all others",
+                             "Country")
+
+
+def region_cases_figure(totals):
+    '''Builds a bar graph of total cases per UN continental region, from
+    access_totals("region").'''
+    return totals_bar_figure(totals['label'].tolist(), totals['total'].tolist(),
+                             "COVID-19 cases by UN continental region", "Region")
+
+
+def country_cases_figure(country, cases):
+    '''Builds the bar graph of one country's cases.
+
+    params
+    ------
+    country : str
+        the name to put in the title
+    cases : sequence
+        (new cases, active cases, new deaths, total cases)
+
+    returns
+    -------
+    dict
+        the figure's data and layout
+    '''
+    return {
+        'data': [{'type': 'bar', 'x': ['New Cases', 'Active Cases', 'New Deaths', 'Total Cases'], 'y': list(cases)}],
+        'layout': {
+            'title': {'text': f"COVID-19 cases in {country}"},
+            'xaxis': {'title': {'text': "Types of cases"}},
+            'yaxis': {'title': {'text': "No. People"}},
+            'font': FIGURE_FONT,
+        },
+    }
+
+
+def country_population_figure(country, stats):
+    '''Builds the bar graph of one country's cases next to its population.
+
+    params
+    ------
+    country : str
+        the name to put in the title
+    stats : sequence
+        (2019 population, new cases, active cases, new deaths, total cases)
+
+    returns
+    -------
+    dict
+        the figure's data and layout
+    '''
+    return {
+        'data': [{
+            'type': 'bar',
+            'x': ['Population (2019)', 'New Cases', 'Active Cases', 'New Deaths', 'Total Cases'],
+            'y': list(stats),
+        }],
+        'layout': {
+            'title': {'text': f"COVID-19 cases compared to {country}'s population"},
+            'xaxis': {'title': {'text': "Types of cases"}},
+            'yaxis': {'title': {'text': "No. People"}},
+            'font': FIGURE_FONT,
+        },
+    }
+
+
+# views drawn for one country, and views across all countries
+COUNTRY_VIEWS = ('cases', 'population')
+FIGURE_VIEWS = ('all', 'top', 'regions') + COUNTRY_VIEWS
+
+
+@timed('render')
+def render_figure(view, country=None, page=None):
+    '''Reads a view's data from the SQL database and builds its figure.
+
+    params
+    ------
+    view : str
+        one of FIGURE_VIEWS
+    country : str
+        the country, in any spelling, for the 'cases' and 'population' views
+    page : int
+        the page of the 'all' view to draw, or None for all of it
+
+    returns
+    -------
+    dict
+        the figure's data and layout
+    '''
+    if view == 'all':
+        return all_cases_figure(access_totals("all"), page)
+    if view == 'top':
+        return top_countries_figure(access_totals("country"))
+    if view == 'regions':
+        return region_cases_figure(access_totals("region"))
+
+    found = find_country(country)
+    name = found[1] if found else country
+    if view == 'cases':
+        return country_cases_figure(name, [value for row in access_cases_table(country) for value in row])
+    if view == 'population':
+        return country_population_figure(name, access_country_stats(country) or [])
+    raise ValueError(f"unknown view {view!r}")
+
+
+class FigureCache:
+    '''Keeps rendered figure JSON in memory as UTF-8 bytes, keyed by (view,
+    country, data version), so repeated views of a country skip both the SQL
+    and building the figure, and the API sends them without re-encoding.
+
+    Entries are evicted least recently used first once their bytes exceed
+    max_bytes, and all of them are dropped once the loaders write new data.
+    '''
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or FIGURE_CACHE_MAX_BYTES
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = None
+        self.lock = threading.RLock()
+
+    def get(self, view, country=None, page=None):
+        '''Returns the figure JSON for a view, rendering it on a miss.
+
+        params
+        ------
+        view : str
+            one of FIGURE_VIEWS
+        country : str
+            the country, in any spelling, for the 'cases' and 'population' views
+        page : int
+            the page of the 'all' view to draw, or None for all of it
+
+        returns
+        -------
+        bytes
+            the figure as UTF-8 JSON
+        '''
+        version = data_version()
+        key = (view, normalize_country_key(country) if view in COUNTRY_VIEWS else '', page, version)
+        with self.lock:
+            if self.version != version:
+                self.clear()
+                self.version = version
+            figure_json = self.entries.get(key)
+            if figure_json is not None:
+                self.entries.move_to_end(key)
+                count('covid_figure_cache_requests_total', result='hit')
+                return figure_json
+            count('covid_figure_cache_requests_total', result='miss')
+
+        figure_json = json.dumps(render_figure(view, country, page), separators=(',', ':'),
+                                 ensure_ascii=False).encode('utf-8')
+        with self.lock:
+            if self.version == version and len(figure_json) <= self.max_bytes and key not in self.entries:
+                self.entries[key] = figure_json
+                self.size += len(figure_json)
+                while self.size > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= len(evicted)
+        return figure_json
+
+    def clear(self):
+        '''Drops every cached figure.'''
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+FIGURE_CACHE = FigureCache()
+
+
+def create_and_display_cases_graphs(user_input):
+    '''Uses plotly to make a bar graph out of user selected data. Launches the plotly graph in the user's browser.
+
+    params
+    ------
+    user_input : str
+        the information the user searches for
+
+    returns
+    -------
+    none
+    '''
+    import plotly.io as pio
 
-DB_NAME = 'covid_stats.sqlite'
+    view = 'all' if user_input.lower() == "all" else 'cases'
+    # the cached dict was built by our own figure builders, so plotly's
+    # validation (the slow part of go.Figure) is skipped
+    return pio.show(json.loads(FIGURE_CACHE.get(view, user_input)), validate=False)
 
 
-########### data gathering and sorting #################
-def scrape_wiki_data():
-    '''Parses wikipedia page for table contents.
+def create_and_display_cases_with_population_graphs(user_input):
+    '''Uses plotly to make a bar graph out of user selected data. Launches the plotly graph in the user's browser.
 
     params
     ------
-    none
+    user_input : str
+        the information the user searches for
 
     returns
     -------
-    dict
-        countries organized by their population data
+    none
     '''
-    wikipedia_url = "https://en.wikipedia.org/wiki/List_of_countries_by_population_(United_Nations)"
-    response = requests.get(wikipedia_url)
-    soup = BeautifulSoup(response.text, "html.parser")
-    make_request_with_cache(wikipedia_url, soup.prettify())
-
-    countries_table = soup.find_all('table', class_='sortable')
-
-    # search through table for headings
-    table = countries_table[0].find_all('th')
-    all_headings = [th.text.strip() for th in table]
-    top_headings = all_headings[:6]
-    cleaned_headings = []
-    for h in top_headings:
-        if "[4]" in h:
-            h = h[0:-3]
-        if "(" in h:
-            h2 = h.split("(")
-            h3 = " (".join(h2)
-            cleaned_headings.append(h3)
-        cleaned_headings.append(h)
-    cleaned_headings.remove(cleaned_headings[4])
-    cleaned_headings.remove(cleaned_headings[5])
-
-    countries_list = []
-    UN_CR_list = []
-    UN_SR_list = []
-    pop_2018_list = []
-    pop_2019_list = []
-    change_list = []
-    countries_pop_dict = {}
-
-    countries_table = soup.find_all('table', class_='sortable')
-    tbody = countries_table[0].find('tbody')
-    trs = tbody.find_all('tr', recursive=False)
-
-    for tr in trs: # we have to loop through each tr to get to the tds
-        tds = tr.find_all('td') # here lie our tds
-        if not tds: # ignore empty elements
-            continue
-
-        # we get our country name by indexing the tds (since there are many tds per tr)
-        country_name = tds[0].text.strip() 
-        if "[" in country_name:
-            country_name = country_name[:-3] # cleaning the wikipedia notation off of the names
-        countries_list.append(country_name)
-        
-        # add UN continental region data to list
-        continental_region = tds[1].text.strip()
-        UN_CR_list.append(continental_region)
-        
-        # add UN statistical region to list
-        statistical_region = tds[2].text.strip()
-        UN_SR_list.append(statistical_region)
-
-        # add 2018 population, clean comma and convert to int
-        pop_2018 = tds[3].text.strip()
-        if ',' in pop_2018:
-            pop_2018 = pop_2018.replace(',', '')
-        pop_2018 = int(pop_2018)
-        pop_2018_list.append(pop_2018)
-
-        # add 2019 population, clean comma and convert to int
-        pop_2019 = tds[4].text.strip()
-        if ',' in pop_2019:
-            pop_2019 = pop_2019.replace(',', '')
-        pop_2019 = int(pop_2019)
-        pop_2019_list.append(pop_2019)
-
-        # add population change percentage
-        change = tds[5].text.strip()
-        change_list.append(change)
-
-    for i in range(len(countries_list)):
-        countries_pop_dict[countries_list[i]] = {
-            'UN continental region': UN_CR_list[i],
-            'UN statistical region': UN_SR_list[i],
-            '2018 population': pop_2018_list[i],
-            '2019 population': pop_2019_list[i],
-            'percentage population change': change_list[i]
-        }
+    import plotly.io as pio
 
-    return countries_pop_dict
+    return pio.show(json.loads(FIGURE_CACHE.get('population', user_input)), validate=False)
 
 
-def make_request(base_url):
-    '''Calls the rapid api and returns a json 
-    of coronavirus cases by country and by continent and even a cruise ship.
+def create_and_display_totals_graph(view):
+    '''Launches the graph of one view across all countries in the user's browser.
 
-    parameters
-    ----------
-    base_url : str
-        the url used to call the api
+    params
+    ------
+    view : str
+        'top' for the most affected countries plus "Others", 'regions' for
+        the totals per UN region, or 'all' for every country
 
     returns
     -------
-    dict
-        a dictionary of countries and continents
+    none
     '''
-    querystring = {"country" : "United States"}
-    headers = {
-        'x-rapidapi-host' : "covid-193.p.rapidapi.com",
-        'x-rapidapi-key' : API_KEY
-    }
+    import plotly.io as pio
 
-    response = requests.request("GET", base_url, headers=headers)
-    make_request_with_cache(base_url, response.json())
+    return pio.show(json.loads(FIGURE_CACHE.get(view)), validate=False)
 
-    return response.json()
 
-
-def create_covid_cases_dict(covid_json):
-    '''Pulls a json from the covid API and returns a cleaned dictonary.
+def show_country_percentage_affected(user_input):
+    '''Takes a country's total COVID-19 cases and divides by its 2019 population
+    to show the user the percentage of the population affected by COVID-19.
 
     params
     ------
-    None
+    user_input : str
+        the information the user searches for
 
     returns
     -------
-    dict
-        a cleaned dictionary with a country as the key and 
-        the values as corresponding new cases, new deaths,
-        active cases, and total cases
+    print : NoneType
+        statement declaring the percentage
     '''
-    # all_countries = make_request(covid_url)['response']
-    all_countries = covid_json['response']
-    make_request_with_cache(covid_url, all_countries)
-
-    countries_list = []
-    new_cases_list = []
-    active_cases_list = []
-    total_cases_list = []
-    new_deaths_list = []
-
-    # add our data to their own lists
-    for country in all_countries:
-        # add countries
-        c = country['country']
-        if c == "USA":
-            c = "United States"
-        if c == "S-Korea":
-            c = "South Korea"
-        if "-" in c:
-            c = c.replace("-", " ")
-        countries_list.append(c)
-
-        # add active cases, convert None to 0
-        active_cases = country['cases']['active']
-        if active_cases == None:
-            active_cases = 0
-        active_cases_list.append(active_cases)
-
-        # add total cases, convert None to 0
-        total_cases = country['cases']['total']
-        if total_cases == None:
-            total_cases = 0
-        total_cases_list.append(total_cases)
-
-        # clean the plus sign off of new cases, convert None to 0
-        new_cases = country['cases']['new']
-        if new_cases != None:
-            new_cases = new_cases[1:]
-        if new_cases == None:
-            new_cases = 0
-        new_cases_list.append(new_cases)
-
-        # clean the plus sign off of new deaths, convert None to 0
-        new_deaths = country['deaths']['new']
-        if new_deaths != None:
-            new_deaths = new_deaths[1:]
-        if new_deaths == None:
-            new_deaths = 0
-        new_deaths_list.append(new_deaths)
-
-    covid_dict = {}
-
-    for i in range(len(countries_list)):
-        covid_dict[countries_list[i]] = {
-            'new cases': new_cases_list[i],
-            'active cases': active_cases_list[i],
-            'new deaths': new_deaths_list[i],
-            'total cases': total_cases_list[i]
-        }
+    metrics = access_country_metrics(user_input)
+    if metrics is None or metrics[2] is None:
+        return print(f"[Error] No population data on file for {user_input}.")
 
-    return covid_dict
+    # cases per capita as a percentage
+    percentage = (metrics[2] * 100)
+    clean_percentage = round(percentage, 4)
 
+    return print(f"COVID-19 has infected {clean_percentage}% of {metrics[0]}'s total population.")
 
-###################### caching ##########################
-def open_cache():
-    ''' Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary.
-    if the cache file doesn't exist, creates a new cache dictionary
-    
-    Parameters
-    ----------
-    None
-    
-    Returns
+    # need to divide total cases by 2019 population. so, access to case table and pop table. 
+    # then conduct simple maths to divide and get a percentage.
+
+##################### static export ############################
+EXPORT_SQL = '''
+    SELECT c.Country, p."2019population", c.NewCases, c.ActiveCases, c.NewDeaths, c.TotalCases, m.CasesPerCapita
+    FROM Cases c
+    LEFT JOIN Population p ON p.CountryId = c.CountryId
+    LEFT JOIN CountryMetrics m ON m.CountryId = c.CountryId
+    ORDER BY c.Country
+'''
+
+DASHBOARD_HTML = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>COVID-19 statistics by country</title>
+<script src="{plotly_js}"></script>
+<style>body {{ font-family: "Roboto Slab", monospace; margin: 2em; }} .chart {{ height: 480px; }}</style>
+</head>
+<body>
+<h1>COVID-19 statistics by country</h1>
+<p><label>Overview <select id="overview">
+<option value="top">Most affected countries</option>
+<option value="regions">By region</option>
+<option value="all">All countries</option>
+</select></label></p>
+<div id="all" class="chart"></div>
+<p><label>Country <select id="country"></select></label></p>
+<p id="percentage"></p>
+<div id="cases" class="chart"></div>
+<div id="population" class="chart"></div>
+<script>
+function show(id, figure) {{
+  if (figure) {{ Plotly.react(id, figure.data, figure.layout); }} else {{ Plotly.purge(id); }}
+}}
+function load(slug) {{
+  fetch("data/" + slug + ".json").then(r => r.json()).then(spec => {{
+    show("cases", spec.cases);
+    show("population", spec.population);
+    document.getElementById("percentage").textContent = spec.percentage === null ? "" :
+      "COVID-19 has infected " + spec.percentage + "% of " + spec.country + "'s total population.";
+  }});
+}}
+const overview = document.getElementById("overview");
+overview.onchange = () => fetch("data/" + overview.value + ".json").then(r => r.json()).then(figure => show("all", figure));
+overview.onchange();
+fetch("data/countries.json").then(r => r.json()).then(countries => {{
+  const select = document.getElementById("country");
+  for (const [name, slug] of countries) {{ select.add(new Option(name, slug)); }}
+  select.onchange = () => load(select.value);
+  if (countries.length) {{ load(countries[0][1]); }}
+}});
+</script>
+</body>
+</html>
+'''
+
+
+def country_slug(country):
+    '''Turns a country name into the name of its JSON file, e.g. "cote-d-ivoire".'''
+    return normalize_country_key(country).replace(' ', '-') or 'unknown'
+
+
+def write_json(path, value):
+    '''Writes compact JSON to a temporary file and moves it into place, so a
+    dashboard being served never sees a half written file.'''
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as json_file:
+        json.dump(value, json_file, separators=(',', ':'), ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def write_country_figures(data_dir, rows):
+    '''Renders and writes the figures for a batch of countries. Runs in a
+    worker process during export_dashboard.
+
+    params
+    ------
+    data_dir : str
+        the folder the JSON files go in
+    rows : list
+        (country, slug, 2019 population, new cases, active cases,
+        new deaths, total cases, cases per capita) rows
+
+    returns
     -------
-    dict
-        the opened cache
+    int
+        the number of countries written
     '''
-    try:
-        cache_file = open(CACHE_FILENAME, 'r')
-        cache_contents = cache_file.read()
-        cache_dict = json.loads(cache_contents)
-        cache_file.close()
-    except:
-        cache_dict = {}
-    return cache_dict
+    for country, slug, population, *cases, per_capita in rows:
+        write_json(os.path.join(data_dir, slug + '.json'), {
+            'country': country,
+            'cases': country_cases_figure(country, cases),
+            'population': None if population is None else country_population_figure(country, [population] + cases),
+            'percentage': None if per_capita is None else round(per_capita * 100, 4),
+        })
+    return len(rows)
 
 
-def save_cache(cache_dict):
-    ''' Saves the current state of the cache to disk
-    
-    Parameters
-    ----------
-    cache_dict: dict
-        The dictionary to save
-    
-    Returns
+@timed('export')
+def export_dashboard(out_dir=None, workers=None):
+    '''Renders every country's figures into a static site that can be served
+    straight from disk: an index.html, one copy of plotly.js shared by every
+    chart, and one compact JSON file per country under data/. The figures are
+    rendered in batches across worker processes.
+
+    params
+    ------
+    out_dir : str
+        the folder to write the site to (EXPORT_DIR by default)
+    workers : int
+        worker processes (EXPORT_WORKERS, or one per core, by default)
+
+    returns
     -------
-    None
+    int
+        the number of countries exported
     '''
-    dumped_json_cache = json.dumps(cache_dict)
-    fw = open(CACHE_FILENAME,"w")
-    fw.write(dumped_json_cache)
-    fw.close() 
+    import concurrent.futures
+    import plotly
 
+    out_dir = out_dir or EXPORT_DIR
+    workers = workers or EXPORT_WORKERS or os.cpu_count() or 1
+    data_dir = os.path.join(out_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    start = time.perf_counter()
 
-def make_request_with_cache(key, value):
-    '''Issues a request to the cache saved to the device.
+    # plotly.js is written once per plotly version and referenced by name
+    plotly_js = f'plotly-{plotly.__version__}.min.js'
+    if not os.path.exists(os.path.join(out_dir, plotly_js)):
+        with open(os.path.join(out_dir, plotly_js), 'wb') as js_file:
+            js_file.write(pkgutil.get_data('plotly', 'package_data/plotly.min.js'))
+    with open(os.path.join(out_dir, 'index.html'), 'w', encoding='utf-8') as html_file:
+        html_file.write(DASHBOARD_HTML.format(plotly_js=plotly_js))
 
-    If the item exists in the cache, the program will pull from that data.
-    If the item does not exist in the cache, the program will create a key/value
-    pair and save it to the cache dictionary
+    conn = get_connection()
+    rows = [(country, country_slug(country), *rest) for country, *rest in conn.execute(EXPORT_SQL)]
+    for view in ('all', 'top', 'regions'):
+        write_json(os.path.join(data_dir, view + '.json'), render_figure(view))
+    write_json(os.path.join(data_dir, 'countries.json'), [[row[0], row[1]] for row in rows])
 
-    Parameters
-    ----------
-    key
-        list
-    value
-        list
+    batch_size = max(1, -(-len(rows) // (workers * 4)))
+    batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    if workers == 1:
+        exported = sum(write_country_figures(data_dir, batch) for batch in batches)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            exported = sum(pool.map(write_country_figures, [data_dir] * len(batches), batches))
 
-    '''
+    print(f"Exported {exported} countries to {out_dir} in {time.perf_counter() - start:.2f}s")
+    return exported
 
-    if key in CACHE_DICT.keys():
-        print("Using cache")
-        return CACHE_DICT[key]
-    else:
-        print("Fetching")
-        CACHE_DICT[key] = value
-        save_cache(CACHE_DICT)
-        return CACHE_DICT[key]
 
+##################### snapshots ############################
+# tables saved in a snapshot, in the order they are restored
+SNAPSHOT_TABLES = ["Countries", "CountryAliases", "Cases", "Population", "CasesHistory", "CountryMetrics"]
 
-##################### database ##########################
-def create_db():
-    ''' Create a SQL database if it doesn't already exist and populate data in the tables.
-    If the database already exists, the function writes over the existing data.
-    
-    Parameters
-    ----------
-    None
-    
-    Returns
-    -------
-    None
-    '''
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+# file extension for each snapshot format
+SNAPSHOT_FORMATS = {'arrow': '.arrow', 'parquet': '.parquet'}
 
-    drop_covid_cases_sql = 'DROP TABLE IF EXISTS "Cases"'
-    drop_country_population_sql = 'DROP TABLE IF EXISTS "Population"'
-    
 
-    create_covid_cases_sql = '''
-        CREATE TABLE IF NOT EXISTS "Cases" (
-            "Id" INTEGER PRIMARY KEY AUTOINCREMENT,
-            "Country" TEXT NOT NULL,
-            "NewCases" INTEGER NOT NULL,
-            "ActiveCases" INTEGER NULL,
-            "NewDeaths" INTEGER NOT NULL,
-            "TotalCases" INTEGER NULL
-        )
-    '''
+def import_pyarrow():
+    '''Imports pyarrow, which only the snapshot commands need.'''
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Snapshots need pyarrow: pip install pyarrow") from None
+    return pyarrow
 
-    create_country_population_sql = '''
-        CREATE TABLE IF NOT EXISTS "Population" (
-            "Id" INTEGER PRIMARY KEY AUTOINCREMENT,
-            "Country" TEXT NOT NULL,
-            "UNContinentalRegion" TEXT NOT NULL,
-            "UNStatisticalRegion" TEXT NOT NULL,
-            "2018population" INTEGER NOT NULL,
-            "2019population" INTEGER NOT NULL,
-            "PopulationChange" TEXT NOT NULL
-        )
-    '''
 
-    cur.execute(drop_covid_cases_sql)
-    cur.execute(create_covid_cases_sql)
-    cur.execute(drop_country_population_sql)
-    cur.execute(create_country_population_sql)
-    conn.commit()
-    conn.close()
+def table_schema(conn, table):
+    '''Builds the arrow schema of a table from its declared column types.'''
+    pa = import_pyarrow()
+    types = {'INTEGER': pa.int64(), 'REAL': pa.float64(), 'TEXT': pa.string()}
+    return pa.schema([
+        (name, types.get(declared.upper(), pa.string()))
+        for _, name, declared, *_ in conn.execute(f'PRAGMA table_info("{table}")')
+    ])
 
 
-def load_cases():
-    '''Loads covid cases into a SQL database.
+def export_snapshot(out_dir, snapshot_format='arrow'):
+    '''Writes the processed tables to a folder as one columnar file each,
+    plus a manifest.json listing them. Arrow IPC files can be memory-mapped
+    by other tools as they are; parquet files are smaller.
+
+    Every table is read inside one transaction, so the files are consistent
+    with each other even while a refresh is running.
 
     params
     ------
-    None
+    out_dir : str
+        the folder to write the snapshot to
+    snapshot_format : str
+        'arrow' or 'parquet'
 
     returns
     -------
-    None
+    dict
+        the manifest
     '''
-    covid_dict = create_covid_cases_dict(make_request(covid_url))
+    pa = import_pyarrow()
+    extension = SNAPSHOT_FORMATS[snapshot_format]
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    manifest = {'format': snapshot_format, 'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'tables': {}}
 
-    insert_sql = '''
-        INSERT INTO Cases
-        VALUES (NULL, ?, ?, ?, ?, ?)
-    '''
+    conn = connect_db()
+    try:
+        conn.execute('BEGIN')
+        manifest['data_version'] = int(conn.execute(
+            "SELECT COALESCE((SELECT Value FROM Meta WHERE Key = 'data_version'), 0)").fetchone()[0])
+        for table in SNAPSHOT_TABLES:
+            schema = table_schema(conn, table)
+            quoted = ", ".join(f'"{name}"' for name in schema.names)
+            rows = conn.execute(f'SELECT {quoted} FROM "{table}"').fetchall()
+            columns = list(zip(*rows)) or [[] for _ in schema.names]
+            arrow_table = pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema)
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+            filename = table + extension
+            temp_path = os.path.join(out_dir, filename + '.tmp')
+            if snapshot_format == 'parquet':
+                pa.parquet.write_table(arrow_table, temp_path, compression='zstd')
+            else:
+                with pa.OSFile(temp_path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+                    writer.write_table(arrow_table)
+            os.replace(temp_path, os.path.join(out_dir, filename))
+            manifest['tables'][table] = {'file': filename, 'rows': len(rows), 'columns': schema.names}
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
 
-    for k,v in covid_dict.items():
-        cur.execute(insert_sql,[
-            k,
-            v['new cases'],
-            v['active cases'],
-            v['new deaths'],
-            v['total cases']
-            ]
-        )
-    conn.commit()
-    conn.close()
-    
+    write_json(os.path.join(out_dir, 'manifest.json'), manifest)
+    rows = sum(t['rows'] for t in manifest['tables'].values())
+    print(f"Exported {rows} rows to {out_dir} in {time.perf_counter() - start:.2f}s")
+    return manifest
 
-def load_population():
-    '''Loads countries' population data into a SQL database.
+
+def import_snapshot(snapshot_dir):
+    '''Replaces the tables with the contents of a snapshot written by
+    export_snapshot, in a single transaction, so the database can be warmed
+    up without scraping or calling the API.
 
     params
     ------
-    None
+    snapshot_dir : str
+        the folder holding manifest.json and the table files
 
     returns
     -------
-    None
+    int
+        the number of rows imported
     '''
-    pop_dict = scrape_wiki_data()
+    pa = import_pyarrow()
+    with open(os.path.join(snapshot_dir, 'manifest.json'), encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+    start = time.perf_counter()
 
-    insert_sql = '''
-        INSERT INTO Population
-        VALUES (NULL, ?, ?, ?, ?, ?, ?)
-    '''
+    create_db()
+    conn = connect_db()
+    imported = 0
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        for table in SNAPSHOT_TABLES:
+            entry = manifest['tables'].get(table)
+            if entry is None:
+                continue
+            columns = table_schema(conn, table).names
+            if entry['columns'] != columns:
+                raise ValueError(f"The snapshot's {table} columns don't match this version of the database")
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+            path = os.path.join(snapshot_dir, entry['file'])
+            if manifest['format'] == 'parquet':
+                arrow_table = pa.parquet.read_table(path)
+            else:
+                with pa.memory_map(path) as source:
+                    arrow_table = pa.ipc.open_file(source).read_all()
+            rows = zip(*(arrow_table.column(name).to_pylist() for name in columns))
 
-    for k,v in pop_dict.items():
-        cur.execute(insert_sql,[
-            k,
-            v['UN continental region'],
-            v['UN statistical region'],
-            v['2018 population'],
-            v['2019 population'],
-            v['percentage population change']
-            ]
-        )
-    conn.commit()
-    conn.close()
+            conn.execute(f'DELETE FROM "{table}"')
+            conn.executemany(f'INSERT INTO "{table}" VALUES ({", ".join("?" * len(columns))})', rows)
+            imported += arrow_table.num_rows
+        # the next startup re-seeds any countries the snapshot lacks, and
+        # the next ingest reloads every source
+        stale_keys = ['countries_hash'] + [source.hash_key for source in SOURCES.values() if source.hash_key]
+        conn.execute('DELETE FROM Meta WHERE Key IN (SELECT value FROM json_each(?))', (json.dumps(stale_keys),))
+        bump_data_version(conn)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
 
+    print(f"Imported {imported} rows from {snapshot_dir} in {time.perf_counter() - start:.2f}s")
+    return imported
 
-##################### accessing DBs via user entry ##########################
-def access_cases_table(country):
-    '''Selects a country's COVID-19 data from the SQL database to display based on user entry.
 
-    Params
+##################### http api ############################
+def api_worker_init():
+    '''Opens an API worker thread's read connection up front and makes it
+    read-only.'''
+    get_connection().execute('PRAGMA query_only = ON')
+
+
+def api_query(route, args, params):
+    '''Answers one API request from the SQL database.
+
+    params
     ------
-    country : str
-        A country to search for in the database.
+    route : str
+        the first part of the path, e.g. "country"
+    args : list
+        the rest of the path, e.g. ["Brazil"]
+    params : dict
+        the query string parameters
 
-    Returns
+    returns
     -------
-    list
-        A country's corresponding COVID-19 data.
-    '''
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    bytes
+        the UTF-8 JSON response body
 
-    if country.lower() == "all":
-        q = f'''
-            SELECT Country, TotalCases
-            FROM Cases
-            ORDER BY TotalCases DESC
-        '''
+    raises
+    ------
+    LookupError
+        for unknown paths and countries that aren't on file
+    ValueError
+        for malformed parameters
+    '''
+    if route == 'figures' and args and args[0] in FIGURE_VIEWS:
+        view = args[0]
+        country = args[1] if len(args) == 2 and view in COUNTRY_VIEWS else None
+        if (view in COUNTRY_VIEWS) != (country is not None) or len(args) > 2:
+            raise LookupError("no such figure")
+        if country is not None and find_country(country) is None:
+            raise LookupError(f"{country} isn't on file.{did_you_mean(country)}")
+        page = params.get('page')
+        return FIGURE_CACHE.get(view, country, None if page is None else int(page))
 
+    if route == 'all' and not args:
+        result = [{'country': c, 'total_cases': t} for c, t in access_cases_table("all")]
+    elif route in QUERY_FIELDS and len(args) == 1:
+        record = access_countries_batch(args)[0]
+        if record['country'] is None:
+            raise LookupError(f"{args[0]} isn't on file.{did_you_mean(args[0])}")
+        result = {k: record[k] for k in QUERY_FIELDS[route]}
+    elif route == 'history' and len(args) == 1:
+        found = find_country(args[0])
+        if found is None:
+            raise LookupError(f"{args[0]} isn't on file.{did_you_mean(args[0])}")
+        result = {
+            'country': found[1],
+            'history': [
+                dict(zip(['day', 'granularity', 'new_cases', 'active_cases', 'new_deaths', 'total_cases'], row))
+                for row in access_cases_history(args[0], int(params.get('days', 30)))
+            ],
+        }
+    elif route == 'search' and not args:
+        result = [{'country': c, 'score': s} for c, s in search_countries(params.get('q', ''), int(params.get('n', 5)))]
+    elif route == 'complete' and not args:
+        result = complete_countries(params.get('q', ''), int(params.get('n', 10)))
+    elif route == 'top' and not args:
+        metric = params.get('metric', 'cases_per_capita')
+        if metric not in METRIC_COLUMNS:
+            raise ValueError(f"metric must be one of {', '.join(METRIC_COLUMNS)}")
+        result = [{'country': c, metric: v} for c, v in access_top_countries(metric, int(params.get('n', 20)))]
     else:
-        q = f'''
-            SELECT NewCases, ActiveCases, NewDeaths, TotalCases
-            FROM Cases
-            WHERE Country = "{country.title()}"
-        '''
-    result = cur.execute(q).fetchall()
-    conn.close()
-    return result
+        raise LookupError("no such resource")
+    return json.dumps(result, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
 
 
-def access_population_table(country):
-    '''Selects a country's population from the SQL database to display based on user entry.
+@timed('api')
+def api_answer(target, headers):
+    '''Builds the response to a GET request. Runs on an API worker thread.
 
-    Params
+    Every successful response carries an ETag made from the data version, so
+    a client repeating a request gets an empty 304 until the loaders write
+    new data. The request is answered first, so an unknown path or a bad
+    parameter still gets its 404 or 400 whatever If-None-Match says.
+
+    params
     ------
-    country : str
-        A country to search for in the database.
+    target : str
+        the request's path and query string
+    headers : dict
+        the request headers, with lowercase names
 
-    Returns
+    returns
     -------
-    list
-        A country's corresponding population data.
+    tuple
+        (status, response headers, body bytes)
     '''
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    q = f'''
-        SELECT "2019population"
-        FROM Population
-        WHERE Country = "{country.title()}"
+    if target.split('?')[0] == '/metrics':
+        return 200, {'Content-Type': 'text/plain; version=0.0.4'}, METRICS.prometheus_text().encode('utf-8')
+
+    # taken before the query, so a load landing meanwhile can't give old data a new tag
+    etag = f'W/"{data_version()}"'
+    url = urllib.parse.urlsplit(target)
+    parts = [urllib.parse.unquote(part) for part in url.path.split('/') if part]
+    params = dict(urllib.parse.parse_qsl(url.query))
+    response_headers = {'Content-Type': 'application/json; charset=utf-8', 'Vary': 'Accept-Encoding'}
+    try:
+        body = api_query(parts[0] if parts else '', parts[1:], params)
+        if etag in [tag.strip() for tag in headers.get('if-none-match', '').split(',')]:
+            return 304, {'ETag': etag, 'Cache-Control': 'no-cache'}, b''
+        status = 200
+        response_headers.update({'ETag': etag, 'Cache-Control': 'no-cache'})
+    except LookupError as e:
+        status, body = 404, json.dumps({'error': str(e)}).encode('utf-8')
+    except ValueError as e:
+        status, body = 400, json.dumps({'error': str(e)}).encode('utf-8')
+
+    if len(body) >= API_GZIP_MIN_BYTES and 'gzip' in headers.get('accept-encoding', ''):
+        body = gzip.compress(body, compresslevel=6)
+        response_headers['Content-Encoding'] = 'gzip'
+    return status, response_headers, body
+
+
+async def handle_api_connection(executor, reader, writer):
+    '''Serves the requests on one client connection, keeping it open
+    between requests unless the client asks to close it. Queries run on the
+    executor's threads so the event loop is never blocked on sqlite.'''
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                method, target, version = None, None, 'HTTP/1.0'
+            if method in ('GET', 'HEAD'):
+                status, response_headers, body = await loop.run_in_executor(executor, api_answer, target, headers)
+            else:
+                status, response_headers, body = 405 if method else 400, {'Allow': 'GET, HEAD'}, b''
+
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+            response_headers['Content-Length'] = str(len(body))
+            response_headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+            head = f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n'
+            head += ''.join(f'{name}: {value}\r\n' for name, value in response_headers.items())
+            writer.write(head.encode('latin-1') + b'\r\n' + (b'' if method == 'HEAD' else body))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_api(host=None, port=None, workers=None):
+    '''Runs the read-only HTTP API until cancelled.
+
+    params
+    ------
+    host : str
+        the address to listen on (API_HOST)
+    port : int
+        the port to listen on (API_PORT)
+    workers : int
+        threads, each with its own read connection, that answer queries
+        (API_WORKERS)
     '''
-    result = cur.execute(q).fetchall()
-    conn.close()
-    return result
+    import asyncio
+    import concurrent.futures
 
+    host = host or API_HOST
+    port = port or API_PORT
+    with concurrent.futures.ThreadPoolExecutor(workers or API_WORKERS, initializer=api_worker_init) as executor:
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_api_connection(executor, reader, writer), host, port)
+        print(f"Serving COVID-19 statistics on http://{host}:{port}/")
+        async with server:
+            await server.serve_forever()
 
-##################### data vis ############################
-def create_and_display_cases_graphs(user_input):
-    '''Uses plotly to make a bar graph out of user selected data. Launches the plotly graph in the user's browser.
+
+##################### misc user entry ############################
+def user_exit():
+    '''Exits python, with a farewell, when executed.
 
     params
     ------
-    user_input : str
-        the information the user searches for
+    none
 
     returns
     -------
     none
     '''
-    if user_input.lower() == "all":
-
-        xvals = []
-        yvals = []
-        for d in access_cases_table(user_input):
-            xvals.append(d[0])
-            yvals.append(d[1])
-
-        bar_data = go.Bar(x=xvals, y=yvals)
-
-        basic_layout = go.Layout(title=f"Combined new, active, and former COVID-19 cases across the globe",
-            xaxis_title = "Country",
-            yaxis_title = "No. People Directly Affected by COVID-19",
-            font=dict(
-                family="Roboto Slab, monospace",
-                size=10,
-                color="#000"
-                ),
-            )
-        
-    else:
-        xvals = ['New Cases', 'Active Cases', 'New Deaths', 'Total Cases']
-        yvals = []
-
-        for d in access_cases_table(user_input):
-            yvals.append(d[0])
-            yvals.append(d[1])
-            yvals.append(d[2])
-            yvals.append(d[3]) 
+    print("Bye!")
+    sys.exit()
 
-        bar_data = go.Bar(x=xvals, y=yvals)
 
-        basic_layout = go.Layout(title=f"COVID-19 cases in {user_input.title()}",
-            xaxis_title = "Types of cases",
-            yaxis_title = "No. People",
-            font=dict(
-                family="Roboto Slab, monospace",
-                size=10,
-                color="#000"
-                ),
-            )   
+##################### command line ############################
+BATCH_STATS_SQL = '''
+    SELECT q.key, c.Name, p."2019population", cs.NewCases, cs.ActiveCases, cs.NewDeaths, cs.TotalCases
+    FROM json_each(?) q
+    LEFT JOIN CountryAliases a ON a.Key = q.value
+    LEFT JOIN Countries c ON c.Id = a.CountryId
+    LEFT JOIN Cases cs ON cs.CountryId = a.CountryId
+    LEFT JOIN Population p ON p.CountryId = a.CountryId
+    ORDER BY q.key
+'''
 
-    fig = go.Figure(data=bar_data, layout=basic_layout)
-    return fig.show()
+# the fields each batch view reports, in output order
+QUERY_FIELDS = {
+    'all': ['country', 'total_cases'],
+    'country': ['query', 'country', 'new_cases', 'active_cases', 'new_deaths', 'total_cases'],
+    'population': ['query', 'country', 'population_2019', 'new_cases', 'active_cases', 'new_deaths', 'total_cases'],
+    'percentage': ['query', 'country', 'total_cases', 'population_2019', 'percentage_affected'],
+}
 
 
-def create_and_display_cases_with_population_graphs(user_input):
-    '''Uses plotly to make a bar graph out of user selected data. Launches the plotly graph in the user's browser.
+@timed('query')
+def access_countries_batch(countries):
+    '''Looks up many countries at once with a single query.
 
     params
     ------
-    user_input : str
-        the information the user searches for
+    countries : list
+        countries to search for, in any spelling
 
     returns
     -------
-    none
+    list
+        one dict per requested country, in the order given; 'country' is None
+        for names that aren't on file
     '''
+    keys = [normalize_country_key(c) for c in countries]
+    rows = get_connection().execute(BATCH_STATS_SQL, (json.dumps(keys),)).fetchall()
 
-    xvals = ['Population (2019)', 'New Cases', 'Active Cases', 'New Deaths', 'Total Cases']
-    yvals = []
+    records = []
+    for position, name, population, new_cases, active_cases, new_deaths, total_cases in rows:
+        percentage = None
+        if population and total_cases is not None:
+            percentage = round(total_cases / population * 100, 4)
+        records.append({
+            'query': countries[position],
+            'country': name,
+            'population_2019': population,
+            'new_cases': new_cases,
+            'active_cases': active_cases,
+            'new_deaths': new_deaths,
+            'total_cases': total_cases,
+            'percentage_affected': percentage,
+        })
+    return records
 
-    for d in access_population_table(user_input):
-        yvals.append(d[0])
 
-    for d in access_cases_table(user_input):
-        yvals.append(d[0])
-        yvals.append(d[1])
-        yvals.append(d[2])
-        yvals.append(d[3]) 
+def read_countries(names, filename):
+    '''Collects the countries given on the command line and, if a file is
+    given ("-" for stdin), one country per non-empty line of it.'''
+    countries = list(names)
+    if filename:
+        f = sys.stdin if filename == '-' else open(filename, encoding='utf-8')
+        with f:
+            countries += [line.strip() for line in f if line.strip()]
+    return countries
 
-    bar_data = go.Bar(x=xvals, y=yvals)
-
-    basic_layout = go.Layout(title=f"COVID-19 cases compared to {user_input.title()}'s population",
-        xaxis_title = "Types of cases",
-        yaxis_title = "No. People",
-        font=dict(
-            family="Roboto Slab, monospace",
-            size=10,
-            color="#000"
-            ),
-        )   
-
-    fig = go.Figure(data=bar_data, layout=basic_layout)
-    return fig.show()
 
+def write_records(records, fields, output_format, out=None):
+    '''Writes records to stdout as a json array or as csv with a header row.'''
+    out = out or sys.stdout
+    if output_format == 'csv':
+        writer = csv.DictWriter(out, fieldnames=fields, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(records)
+    else:
+        json.dump([{k: r[k] for k in fields} for r in records], out, ensure_ascii=False)
+        out.write('\n')
 
-def show_country_percentage_affected(user_input):
-    '''Takes a country's total COVID-19 cases and divides by its 2019 population
-    to show the user the percentage of the population affected by COVID-19.
 
-    params
-    ------
-    user_input : str
-        the information the user searches for
+def run_query(args):
+    '''Answers one of the four views for any number of countries, straight
+    from the SQL database: no prompts, no sleeps and no browser.
 
     returns
     -------
-    print : NoneType
-        statement declaring the percentage
+    int
+        the exit status: 1 if any requested country wasn't on file
     '''
-    population_and_total_cases_list = []
+    if args.update:
+        # keep progress messages out of the json/csv on stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            open_cache_if_needed()
+            ingest(args.source, max_age=0)
 
-    for d in access_cases_table(user_input):
-        population_and_total_cases_list.append(d[3])
+    if args.command == 'all':
+        records = [{'country': c, 'total_cases': t} for c, t in access_cases_table("all")]
+        write_records(records, QUERY_FIELDS['all'], args.format)
+        return 0
 
-    for d in access_population_table(user_input):
-        population_and_total_cases_list.append(d[0])
+    countries = read_countries(args.countries, args.file)
+    if not countries:
+        print("[Error] Give at least one country, or a file of them with --file.", file=sys.stderr)
+        return 2
+    records = access_countries_batch(countries)
+    write_records(records, QUERY_FIELDS[args.command], args.format)
 
-    # divide numbers to get a percentage
-    divide_covid_totals_by_population = (population_and_total_cases_list[0] / population_and_total_cases_list[1])
-    percentage = (divide_covid_totals_by_population * 100)
-    clean_percentage = round(percentage, 4)
+    missing = [r['query'] for r in records if r['country'] is None]
+    for query in missing:
+        print(f"[Error] {query} isn't on file.{did_you_mean(query)}", file=sys.stderr)
+    if missing:
+        return 1
+    return 0
 
-    return print(f"COVID-19 has infected {clean_percentage}% of {user_input.title()}'s total population.")
 
-    # need to divide total cases by 2019 population. so, access to case table and pop table. 
-    # then conduct simple maths to divide and get a percentage.
+def source_spec(spec):
+    '''Turns a --source value into a Source, for argparse.'''
+    try:
+        return make_source(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
-##################### misc user entry ############################
-def user_exit():
-    '''Exits python, with a farewell, when executed.
+
+def build_arg_parser():
+    '''Builds the command line parser. With no command the interactive menu runs.'''
+    parser = argparse.ArgumentParser(description="View COVID-19 statistics by country.")
+    parser.add_argument('--full-reload', action='store_true',
+        help="rebuild the tables from scratch instead of refreshing changed rows")
+    parser.add_argument('--refresh', action='store_true',
+        help="keep refreshing the data in the background while the menu runs")
+    parser.add_argument('--metrics', action='store_true',
+        help="time each stage and log the metrics as a JSON line on exit (served on /metrics by serve)")
+    parser.add_argument('--source', action='append', type=source_spec, metavar='NAME[=LOCATION]',
+        help=f"read data from this source, repeatable: {', '.join(SOURCES)} "
+             f"(default: {' and '.join(DEFAULT_SOURCES)}), e.g. jhu=csse_covid_19_time_series")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    views = {
+        'all': "COVID-19 cases across all countries",
+        'country': "detailed COVID-19 information for countries",
+        'population': "COVID-19 information along with each country's 2019 population",
+        'percentage': "the percentage of each country's population affected by COVID-19",
+    }
+    for name, help_text in views.items():
+        view = commands.add_parser(name, help=help_text, description=f"Print {help_text}.")
+        if name != 'all':
+            view.add_argument('countries', nargs='*', help="countries to look up, in any spelling")
+            view.add_argument('--file', help="file with one country per line (- for stdin)")
+        view.add_argument('--format', choices=['json', 'csv'], default='json', help="output format")
+        view.add_argument('--update', action='store_true',
+            help="refresh the data from the sources before answering")
+
+    commands.add_parser('ingest', help="bring the SQL database up to date from the sources and exit")
+
+    backfill = commands.add_parser('backfill', help="backfill per-country history from the covid API")
+    backfill.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help="worker threads")
+    backfill.add_argument('--rate', type=float, default=BACKFILL_REQUESTS_PER_SECOND, help="requests per second")
+    backfill.add_argument('--restart', action='store_true', help="ignore earlier checkpoints")
+    backfill.add_argument('countries', nargs='*', help="API country names (default: all)")
+
+    snapshot = commands.add_parser('snapshot', help="export the tables to, or import them from, columnar files")
+    snapshot.add_argument('action', choices=['export', 'import'])
+    snapshot.add_argument('path', help="the snapshot folder")
+    snapshot.add_argument('--format', choices=list(SNAPSHOT_FORMATS), default='arrow',
+        help="file format to export (arrow IPC or parquet)")
+
+    serve = commands.add_parser('serve', help="serve the SQL database over a read-only HTTP API")
+    serve.add_argument('--host', default=API_HOST, help="address to listen on")
+    serve.add_argument('--port', type=int, default=API_PORT, help="port to listen on")
+    serve.add_argument('--workers', type=int, default=API_WORKERS, help="query threads")
+
+    search = commands.add_parser('search', help="find countries by approximate name")
+    search.add_argument('text', help="a country name, possibly misspelled or partly typed")
+    search.add_argument('-n', type=int, default=5, help="most matches to list")
+    search.add_argument('--prefix', action='store_true', help="autocomplete text instead of fuzzy matching it")
+    search.add_argument('--format', choices=['json', 'csv'], default='json', help="output format")
+
+    top = commands.add_parser('top', help="rank countries by a per-capita metric")
+    top.add_argument('--metric', choices=list(METRIC_COLUMNS), default='cases_per_capita', help="metric to rank by")
+    top.add_argument('-n', type=int, default=20, help="number of countries to list")
+    top.add_argument('--format', choices=['json', 'csv'], default='json', help="output format")
+
+    export = commands.add_parser('export', help="render every country's figures into a static site")
+    export.add_argument('--out', default=EXPORT_DIR, help="folder to write the site to")
+    export.add_argument('--workers', type=int, default=EXPORT_WORKERS, help="worker processes (default: one per core)")
+    export.add_argument('--update', action='store_true', help="refresh the data from the sources first")
+
+    refresher = commands.add_parser('refresher', help="keep the SQL database current until interrupted")
+    refresher.add_argument('--cases-interval', type=float, default=REFRESH_INTERVALS['cases'],
+        help="seconds between cases refreshes")
+    refresher.add_argument('--population-interval', type=float, default=REFRESH_INTERVALS['population'],
+        help="seconds between population refreshes")
+    refresher.add_argument('--jitter', type=float, default=REFRESH_JITTER, help="random fraction added to each wait")
+    return parser
+
+
+def open_cache_if_needed():
+    '''Opens the on-disk cache the first time a command needs to fetch.'''
+    global CACHE_DICT
+    if not isinstance(CACHE_DICT, CacheStore):
+        CACHE_DICT = open_cache()
+
+
+def main(argv=None):
+    '''Runs the command given on the command line, or the interactive menu.'''
+    global METRICS_ENABLED
+    args = build_arg_parser().parse_args(argv)
+    if args.metrics or METRICS_ENABLED:
+        METRICS_ENABLED = True
+        atexit.register(log_metrics)
+
+    if args.command in QUERY_FIELDS:
+        create_db()
+        sys.exit(run_query(args))
+    if args.command == 'search':
+        create_db()
+        if args.prefix:
+            return write_records([{'country': c} for c in complete_countries(args.text, args.n)], ['country'], args.format)
+        records = [{'country': c, 'score': s} for c, s in search_countries(args.text, args.n)]
+        return write_records(records, ['country', 'score'], args.format)
+    if args.command == 'top':
+        create_db()
+        records = [{'country': c, args.metric: v} for c, v in access_top_countries(args.metric, args.n)]
+        return write_records(records, ['country', args.metric], args.format)
+
+    if args.command == 'snapshot':
+        create_db()
+        try:
+            if args.action == 'export':
+                export_snapshot(args.path, args.format)
+            else:
+                import_snapshot(args.path)
+        except (ImportError, OSError, ValueError) as e:
+            print(f"[Error] {e}")
+            sys.exit(1)
+        return
+
+    if args.command == 'serve':
+        import asyncio
+
+        create_db()
+        try:
+            return asyncio.run(serve_api(args.host, args.port, args.workers))
+        except KeyboardInterrupt:
+            user_exit()
+
+    if args.command == 'export':
+        create_db()
+        if args.update:
+            open_cache_if_needed()
+            ingest(args.source, max_age=0)
+        return export_dashboard(args.out, args.workers)
+
+    open_cache_if_needed()
+    if args.command == 'backfill':
+        backfill_history(args.workers, args.rate, args.countries or None, args.restart)
+    elif args.command == 'refresher':
+        create_db()
+        refresher = Refresher({'cases': args.cases_interval, 'population': args.population_interval},
+                              args.jitter, run_now=True, sources=args.source)
+        try:
+            refresher.run()
+        except KeyboardInterrupt:
+            user_exit()
+    elif args.command == 'ingest':
+        ingest(args.source, full_reload=args.full_reload, max_age=0)
+    else:
+        ingest(args.source, full_reload=args.full_reload)
+        if args.refresh:
+            Refresher(sources=args.source).start()
+        interactive_menu()
+
+
+def interactive_menu():
+    '''Runs the interactive, prompt driven menu until the user exits.
 
     params
     ------
@@ -616,21 +4196,6 @@ def user_exit():
     -------
     none
     '''
-    print("Bye!")
-    sys.exit()
-
-if __name__ == '__main__':
-    CACHE_DICT = open_cache()
-    create_covid_cases_dict(make_request(covid_url))
-    covid_cases_dict = create_covid_cases_dict(make_request(covid_url))
-    scrape_wiki_data()
-    create_db()
-    load_cases()
-    load_population()
-    # create_and_display_cases_with_population_graphs("Japan")
-    # show_country_percentage_affected("Bangladesh")
-    # create_and_display_graphs("South Korea")
-    
     switch = True
     while True:
         while switch == True:
@@ -650,13 +4215,29 @@ Type \"exit\" to quit.\n
             
             elif view_data.isnumeric():
 
-                ## view all countries
+                ## view all countries, the most affected ones by default
                 if view_data == "1":
+                    switch = "option1"
                     print("You selected to view COVID-19 cases across all countries.")
-                    print("A graph will now launch in your browser.")
-                    view_data = "all"
-                    time.sleep(1)
-                    create_and_display_cases_graphs(view_data)
+                    while switch == "option1":
+                        view = input(f'''
+Press enter (or type \"top\") to view the {ALL_CHART_TOP_N} most affected countries, with the rest summed into \"Others\".
+Type \"regions\" to view the totals per UN continental region.
+Type \"all\" to view every country.
+Type \"back\" to go back.
+Type \"exit\" to quit.
+''').strip().lower() or "top"
+                        if view == "exit":
+                            user_exit()
+                        elif view == "back":
+                            switch = True
+                            break
+                        elif view not in ("top", "regions", "all"):
+                            print("[Error] Please type top, regions or all.")
+                        else:
+                            print("A graph will now launch in your browser.")
+                            time.sleep(1)
+                            create_and_display_totals_graph(view)
 
                 ## view detailed info based on one country
                 elif view_data == "2":
@@ -672,11 +4253,12 @@ Type \"exit\" to quit.
                             user_exit()
                         elif country.lower() == "back":
                             switch = True
-                        elif country.title() not in covid_cases_dict.keys():
-                            print("[Error] That record doesn't seem to be on file. Check your spelling?")
+                        elif find_country(country) is None:
+                            print("[Error] That record doesn't seem to be on file." + (did_you_mean(country) or " Check your spelling?"))
                             switch = False
                         else:
-                            print(f"Launching graph for {country.title()}")
+                            country = find_country(country)[1]
+                            print(f"Launching graph for {country}")
                             time.sleep(1)
                             create_and_display_cases_graphs(country)
 
@@ -695,11 +4277,12 @@ Type \"exit\" to quit.
                         elif country.lower() == "back":
                             switch = True
                             break
-                        elif country.title() not in covid_cases_dict.keys():
-                            print("[Error] That record doesn't seem to be on file. Check your spelling?")
+                        elif find_country(country) is None:
+                            print("[Error] That record doesn't seem to be on file." + (did_you_mean(country) or " Check your spelling?"))
                             switch = "option3"
                         else:
-                            print(f"Launching graph for {country.title()}")
+                            country = find_country(country)[1]
+                            print(f"Launching graph for {country}")
                             time.sleep(1)
                             create_and_display_cases_with_population_graphs(country)
 
@@ -718,13 +4301,17 @@ Type \"exit\" to quit.
                         elif country.lower() == "back":
                             switch = True
                             break
-                        elif country.title() not in covid_cases_dict.keys():
-                            print("[Error] That record doesn't seem to be on file. Check your spelling?")
+                        elif find_country(country) is None:
+                            print("[Error] That record doesn't seem to be on file." + (did_you_mean(country) or " Check your spelling?"))
                         else:
-                            show_country_percentage_affected(country)
+                            show_country_percentage_affected(find_country(country)[1])
             elif view_data != "1" "2" "3" or "4":
                 print("[Error] Please enter a valid number.")
             elif view_data.isaplha():
                 print("[Error] Please enter a valid number.")
             else:
                 pass
+
+
+if __name__ == '__main__':
+    main()